@@ -0,0 +1,358 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import osm_manip
+
+
+LAT_0 = 28.1185796
+LON_0 = -81.8306738
+LANE_WIDTH = 3.5
+SEGMENT_LENGTH = 200.0
+NODE_SPACING = 10.0
+M_TO_LAT = 90.0 / 10000000.0
+
+
+# Class: SyntheticMap
+#
+# What generate_map wrote, so benchmarks know which ids to ask about
+#
+# Members:
+#
+#    lanelets - The lanelet grid, lanelets[lane][segment]
+#    boundaries - The boundary ways, boundaries[row][segment], row 0 being the right edge of lane 0
+#    duplicate_nodes - [(original, duplicate), ...] nodes at the same position
+#    doubled_lanelets - Lanelets added on top of an existing boundary with the same role
+#    orphan_nodes - Nodes nothing references
+#    node_count, way_count, relation_count - Totals written
+#
+class SyntheticMap:
+
+    def __init__(self):
+        self.lanelets = []
+        self.boundaries = []
+        self.duplicate_nodes = []
+        self.doubled_lanelets = []
+        self.orphan_nodes = []
+        self.node_count = 0
+        self.way_count = 0
+        self.relation_count = 0
+
+    def all_lanelets(self):
+        return [lanelet for lane in self.lanelets for lanelet in lane] + self.doubled_lanelets
+
+
+# Function: generate_map
+#
+# Writes a deterministic lanelet2 style map: lanes side by side, each cut into 200 m lanelets whose boundaries are
+# shared with the neighbouring lane and successor. Elements are written the way JOSM saves a lanelet2 map: double
+# quoted id, action, visible and version attributes, then lat and lon on nodes, so timings reflect the files the
+# tools are used on. osm_manip finds attributes by name, so the order isn't required. The tmerc geoReference gives
+# the projection lengths and offsets are measured in
+#
+# Parameters:
+#
+#    osm_file - where to write the map
+#    lanelet_count - about how many lanelets to make
+#    lanes - lanes side by side
+#    duplicates - nodes to duplicate, the copy replacing the original in one of the two ways sharing it
+#    doubled - lanelets to add that reuse an existing boundary with the same role, like a backwards drawn lanelet
+#    orphans - nodes to add that nothing references
+#    seed - seed for choosing where to inject the errors
+#
+# Returns:
+#
+#    SyntheticMap
+#
+def generate_map(osm_file, lanelet_count, lanes=4, duplicates=None, doubled=None, orphans=None, seed=0):
+    rng = random.Random(seed)
+    segments = max(lanelet_count // lanes, 1)
+    duplicates = max(lanelet_count // 20, 1) if duplicates is None else duplicates
+    doubled = max(lanelet_count // 50, 1) if doubled is None else doubled
+    orphans = max(lanelet_count // 20, 1) if orphans is None else orphans
+    lon_scale = 1.0 / np.cos(LAT_0 * np.pi / 180)
+    synthetic = SyntheticMap()
+
+    next_id = iter(range(1, 1 << 62))
+    nodes = {}
+
+    def node(x, y):
+        id = next(next_id)
+        nodes[id] = (LAT_0 + y * M_TO_LAT, LON_0 + x * M_TO_LAT * lon_scale)
+        return id
+
+    # One row of nodes per lane boundary
+    per_segment = int(SEGMENT_LENGTH // NODE_SPACING)
+    rows = [[node(i * NODE_SPACING, row * LANE_WIDTH) for i in range(segments * per_segment + 1)]
+            for row in range(lanes + 1)]
+
+    ways = {}
+    boundaries = []
+    for row_number, row in enumerate(rows):
+        row_ways = []
+        for segment in range(segments):
+            id = next(next_id)
+            ways[id] = ('dashed' if 0 < row_number < lanes else 'solid',
+                        row[segment * per_segment:(segment + 1) * per_segment + 1])
+            row_ways.append(id)
+        boundaries.append(row_ways)
+    synthetic.boundaries = boundaries
+
+    relations = []
+    speed_limit = next(next_id)
+    for lane in range(lanes):
+        lane_lanelets = []
+        for segment in range(segments):
+            id = next(next_id)
+            relations.append(lanelet_lines(id, boundaries[lane + 1][segment], boundaries[lane][segment],
+                                           speed_limit))
+            lane_lanelets.append(id)
+        synthetic.lanelets.append(lane_lanelets)
+    relations.append(speed_limit_lines(speed_limit, synthetic.lanelets[0][0]))
+
+    # The first node of a segment is also the last of the segment before it, so the duplicate leaves the original
+    # in use and breaks the connection between the two lanelets, the way a badly snapped node does
+    continuing = [way_id for row_ways in boundaries for way_id in row_ways[1:]]
+    for way_id in rng.sample(continuing, min(duplicates, len(continuing))):
+        subtype, refs = ways[way_id]
+        duplicate = next(next_id)
+        nodes[duplicate] = nodes[refs[0]]
+        synthetic.duplicate_nodes.append((refs[0], duplicate))
+        ways[way_id] = (subtype, [duplicate] + refs[1:])
+
+    for lane, segment in rng.sample([(lane, segment) for lane in range(lanes) for segment in range(segments)],
+                                    min(doubled, lanes * segments)):
+        # A lanelet on the far side of the lane's left boundary, drawn with the boundary as its left too
+        left = boundaries[lane + 1][segment]
+        _, left_refs = ways[left]
+        y = (lane + 2) * LANE_WIDTH + 1.0
+        right = next(next_id)
+        ways[right] = ('solid', [node(x, y) for x in
+                                 np.arange(segment * SEGMENT_LENGTH, (segment + 1) * SEGMENT_LENGTH + 1,
+                                           NODE_SPACING)[::-1]])
+        id = next(next_id)
+        relations.append(lanelet_lines(id, left, right))
+        synthetic.doubled_lanelets.append(id)
+
+    for _ in range(orphans):
+        synthetic.orphan_nodes.append(node(rng.uniform(0, segments * SEGMENT_LENGTH), -50.0))
+
+    with open(osm_file, 'w') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write("<osm version='0.6' upload='false' generator='osm_benchmark'>\n")
+        f.write(f"  <geoReference>+proj=tmerc +lat_0={LAT_0} +lon_0={LON_0} +k=1 +x_0=0 +y_0=0 +datum=WGS84 "
+                f"+units=m +no_defs </geoReference>\n")
+        for id, (lat, lon) in nodes.items():
+            f.write(f'  <node id="{id}" action="modify" visible="true" version="1" lat="{lat:.11f}" '
+                    f'lon="{lon:.11f}">\n    <tag k="ele" v="0"/>\n  </node>\n')
+        for id, (subtype, refs) in ways.items():
+            f.write(f'  <way id="{id}" action="modify" visible="true" version="1">\n'
+                    f'    <tag k="type" v="line_thin"/>\n    <tag k="subtype" v="{subtype}"/>\n')
+            f.writelines(f'    <nd ref="{ref}"/>\n' for ref in refs)
+            f.write('  </way>\n')
+        f.writelines(relations)
+        f.write('</osm>\n')
+
+    synthetic.node_count = len(nodes)
+    synthetic.way_count = len(ways)
+    synthetic.relation_count = len(relations)
+    return synthetic
+
+
+def lanelet_lines(id, left, right, regulatory_element=None):
+    lines = (f'  <relation id="{id}" action="modify" visible="true" version="1">\n'
+             f'    <member type="way" ref="{left}" role="left"/>\n'
+             f'    <member type="way" ref="{right}" role="right"/>\n')
+    if regulatory_element is not None:
+        lines += f'    <member type="relation" ref="{regulatory_element}" role="regulatory_element"/>\n'
+    return lines + ('    <tag k="type" v="lanelet"/>\n    <tag k="subtype" v="road"/>\n'
+                    '    <tag k="one_way" v="yes"/>\n  </relation>\n')
+
+
+def speed_limit_lines(id, lanelet):
+    return (f'  <relation id="{id}" action="modify" visible="true" version="1">\n'
+            f'    <tag k="type" v="regulatory_element"/>\n    <tag k="subtype" v="digital_speed_limit"/>\n'
+            f'    <tag k="limit" v="70 mph"/>\n    <tag k="participant:vehicle" v="yes"/>\n'
+            f'    <member type="relation" ref="{lanelet}" role="refers"/>\n  </relation>\n')
+
+
+# Each benchmark gets its own copy of the map and the SyntheticMap, and runs one public operation on it
+BENCHMARKS = {
+    'parse': lambda osm_file, synthetic: osm_manip.OsmDocument(osm_file),
+    'parse_parallel': lambda osm_file, synthetic: osm_manip.parse_parallel(osm_file),
+    'load_cached': lambda osm_file, synthetic: osm_manip.OsmDocument(osm_file, cache=True),
+    'index_lookups': lambda osm_file, synthetic: lookup_elements(osm_file, synthetic),
+    'deduplicate_points': lambda osm_file, synthetic: osm_manip.deduplicate_points(osm_file),
+    'remove_orphaned_points': lambda osm_file, synthetic: osm_manip.remove_orphaned_points(osm_file),
+    'remove_points': lambda osm_file, synthetic: osm_manip.remove_points(
+        [original for original, _ in synthetic.duplicate_nodes] + synthetic.orphan_nodes, osm_file),
+    'merge_nearby_points': lambda osm_file, synthetic: osm_manip.merge_nearby_points(osm_file),
+    'deduplicate_ways': lambda osm_file, synthetic: osm_manip.deduplicate_ways(osm_file),
+    'set_fixed_offset': lambda osm_file, synthetic: osm_manip.set_fixed_offset(osm_file, 1.0, 1.0),
+    'set_fixed_offset_memory': lambda osm_file, synthetic: osm_manip.set_fixed_offset(
+        osm_file, 1.0, 1.0, streaming=False),
+    'make_ways_dashed': lambda osm_file, synthetic: osm_manip.make_ways_dashed(osm_file, synthetic.boundaries[0]),
+    'reverse_lanelets': lambda osm_file, synthetic: osm_manip.reverse_lanelets(osm_file, synthetic.lanelets[0]),
+    'compute_lanelet_length': lambda osm_file, synthetic: osm_manip.compute_lanelet_length(osm_file, LAT_0, LON_0),
+    'get_doubled_centerlines': lambda osm_file, synthetic: osm_manip.get_doubled_centerlines(osm_file),
+    'fix_doubled_centerlines': lambda osm_file, synthetic: osm_manip.fix_doubled_centerlines(None, osm_file),
+    'remove_lanelets_except': lambda osm_file, synthetic: osm_manip.remove_lanelets_except(
+        osm_file, synthetic.lanelets[0][:max(len(synthetic.lanelets[0]) // 2, 1)]),
+    'split_long_lanelets': lambda osm_file, synthetic: osm_manip.split_long_lanelets(osm_file, 60.0),
+    'route_lanelets': lambda osm_file, synthetic: osm_manip.route_lanelets(
+        synthetic.lanelets[0][0], synthetic.lanelets[-1][-1], osm_file, lane_change_cost=5.0),
+    'check_lanelets_for_route': lambda osm_file, synthetic: osm_manip.check_lanelets_for_route(
+        synthetic.lanelets[0], osm_file),
+    'find_lanelets_near': lambda osm_file, synthetic: osm_manip.find_lanelets_near(osm_file, LAT_0, LON_0, 50.0),
+}
+
+# Runs on the fresh copy before a benchmark is measured, for benchmarks of warm caches
+BENCHMARK_SETUP = {
+    'load_cached': lambda osm_file, synthetic: osm_manip.OsmDocument(osm_file, cache=True),
+    'index_lookups': lambda osm_file, synthetic: osm_manip.load_element_index(osm_file),
+}
+
+
+# Reads every boundary way of lane 0 and every duplicated and orphan node through the element index
+def lookup_elements(osm_file, synthetic):
+    for way_id in synthetic.boundaries[0]:
+        osm_manip.get_way_data_from_file(way_id, osm_file)
+    for original, duplicate in synthetic.duplicate_nodes:
+        osm_manip.get_lat_lon_from_point(original, osm_file)
+        osm_manip.get_lat_lon_from_point(duplicate, osm_file)
+    for node_id in synthetic.orphan_nodes:
+        osm_manip.get_lat_lon_from_point(node_id, osm_file)
+
+
+# Function: run_benchmarks
+#
+# Times every benchmark at every map size, on a fresh copy of the generated map each time. Timed runs don't trace
+# memory, tracemalloc slows Python code down far more than numpy code, so the peak comes from one extra traced run
+#
+# Parameters:
+#
+#    sizes - lanelet counts to generate maps with
+#    names - benchmarks to run, defaults to all of BENCHMARKS
+#    repeat - timed runs per benchmark, the fastest is kept
+#
+# Returns:
+#
+#    {'environment': {...}, 'results': [{'benchmark', 'lanelets', 'nodes', 'seconds', 'peak_bytes'}, ...]}
+#
+def run_benchmarks(sizes, names=None, repeat=1, seed=0):
+    if names is None:
+        names = list(BENCHMARKS)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='osm_benchmark.')
+    try:
+        for size in sizes:
+            map_file = os.path.join(work_dir, f'map_{size}.osm')
+            synthetic = generate_map(map_file, size, seed=seed)
+            for name in names:
+                osm_file = os.path.join(work_dir, f'{name}_{size}.osm')
+                setup = BENCHMARK_SETUP.get(name)
+                best_seconds = min(run_on_copy(time_call, BENCHMARKS[name], map_file, osm_file, synthetic, setup)
+                                   for _ in range(max(repeat, 1)))
+                best_peak = run_on_copy(trace_peak, BENCHMARKS[name], map_file, osm_file, synthetic, setup)
+                print(f'{name:>24} {size:>7} lanelets {best_seconds:9.4f} s {best_peak / 1e6:9.1f} MB')
+                results.append({'benchmark': name, 'lanelets': len(synthetic.all_lanelets()),
+                                'nodes': synthetic.node_count, 'seconds': best_seconds, 'peak_bytes': best_peak})
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'machine': platform.machine(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+# Runs measurement on a fresh copy of map_file at osm_file, after setup if there is one, then removes the copy and
+# any caches left next to it
+def run_on_copy(measurement, benchmark, map_file, osm_file, synthetic, setup=None):
+    shutil.copyfile(map_file, osm_file)
+    try:
+        if setup is not None:
+            with contextlib.redirect_stdout(io.StringIO()):
+                setup(osm_file, synthetic)
+        return measurement(benchmark, osm_file, synthetic)
+    finally:
+        work_dir = os.path.dirname(osm_file)
+        for leftover in os.listdir(work_dir):
+            if leftover.startswith(os.path.basename(osm_file)):
+                os.remove(os.path.join(work_dir, leftover))
+
+
+# Wall time of one call with its printing silenced, and without memory tracing
+def time_call(benchmark, osm_file, synthetic):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        benchmark(osm_file, synthetic)
+    return time.perf_counter() - start
+
+
+# Peak traced memory of one call, with its printing silenced
+def trace_peak(benchmark, osm_file, synthetic):
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            benchmark(osm_file, synthetic)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+# Function: compare_results
+#
+# Prints new/old time and memory for every benchmark both runs have, flagging anything more than threshold slower
+#
+# Returns:
+#
+#    [(benchmark, lanelets, time ratio), ...] for the regressions
+#
+def compare_results(old, new, threshold=1.25):
+    old_results = {(result['benchmark'], result['lanelets']): result for result in old['results']}
+    regressions = []
+    for result in new['results']:
+        key = (result['benchmark'], result['lanelets'])
+        if key not in old_results:
+            continue
+        time_ratio = result['seconds'] / max(old_results[key]['seconds'], 1e-9)
+        memory_ratio = result['peak_bytes'] / max(old_results[key]['peak_bytes'], 1)
+        flag = '  REGRESSION' if time_ratio > threshold else ''
+        print(f'{key[0]:>24} {key[1]:>7} lanelets  time x{time_ratio:5.2f}  memory x{memory_ratio:5.2f}{flag}')
+        if flag:
+            regressions.append((key[0], key[1], time_ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time osm_manip operations on synthetic lanelet2 maps')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000], help='lanelet counts')
+    parser.add_argument('--benchmarks', nargs='+', choices=sorted(BENCHMARKS), help='defaults to all')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--generate', help='only write a map with the first size to this file')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_map(args.generate, args.sizes[0], seed=args.seed)
+    else:
+        report = run_benchmarks(args.sizes, args.benchmarks, args.repeat, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare_results(json.load(f), report)
@@ -1,7 +1,2860 @@
 
 import numpy as np
+import atexit
+import collections
+import concurrent.futures
+import contextlib
 import copy
+import functools
+import hashlib
+import heapq
+import inspect
+import io
+import itertools
+import mmap
 import os
+import re
+import shutil
+import tempfile
+import time
+import traceback
+import zipfile
+
+
+STREAM_BUFFER_SIZE = 1 << 20
+# Files smaller than this parse faster serially than through parse_parallel's process pool
+PARALLEL_PARSE_MIN_SIZE = 8 << 20
+# What reading a missing, truncated, empty or foreign .npz cache can raise. Any of them means rebuild the cache
+CACHE_READ_ERRORS = (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile)
+GEO_LAT_0 = re.compile(r'(\+lat_0=)(\S+)')
+GEO_LON_0 = re.compile(r'(\+lon_0=)(\S+)')
+GEO_PARAMETER = re.compile(r'\+(\w+)=([^\s<]+)')
+# name="value" or name='value' anywhere in a line: group 1 is everything up to the opening quote, group 2 the quote,
+# group 3 the value
+ATTRIBUTES = {name: re.compile(r'(\s' + name + r'\s*=\s*)(["\'])(.*?)\2')
+              for name in ('id', 'lat', 'lon', 'ref', 'type', 'role', 'k', 'v')}
+NODE_START = ('<node ', '<node\t')
+WAY_START = ('<way ', '<way\t')
+RELATION_START = ('<relation ', '<relation\t')
+ND_START = ('<nd ', '<nd\t')
+MEMBER_START = ('<member ', '<member\t')
+TAG_START = ('<tag ', '<tag\t')
+CHUNK_BOUNDARY = re.compile(rb'\n[ \t]*<(?:node|way|relation)[\s>/]')
+ELEMENT_START = re.compile(rb'<(node|way|relation)\b[^>]*?\sid=(["\'])(-?\d+)\2')
+DOT_VERTEX = re.compile(r'^\s*(\w+)\s*\[.*\blanelet="?(-?\d+)"?')
+DOT_EDGE = re.compile(r'^\s*(\w+)\s*->\s*(\w+)(?:.*\blabel="?([^"\]\s]*))?')
+
+
+# Class: OsmNode
+#
+# A <node> element. The raw lines are kept so the element is written back exactly as it was read
+#
+class OsmNode:
+    __slots__ = ('id', 'lat', 'lon', 'lines')
+
+    def __init__(self, id, lat, lon, lines):
+        self.id = id
+        self.lat = lat
+        self.lon = lon
+        self.lines = lines
+
+    def set_lat_lon(self, lat, lon):
+        line = set_attribute(self.lines[0], 'lat', str(lat))
+        self.lines[0] = set_attribute(line, 'lon', str(lon))
+        self.lat = lat
+        self.lon = lon
+
+
+# Class: OsmWay
+#
+# A <way> element, split the same way get_way_data_from_file always has
+#
+# Members:
+#
+#    metadata - The header, and any lines before the nodes
+#    data - The <nd ref=.../> lines
+#    refs - The node ids of data, in the same order
+#    end - Any lines after the nodes
+#    index - The line in the osm file that the </way> was located at
+#
+class OsmWay:
+    __slots__ = ('id', 'metadata', 'data', 'refs', 'end', 'index')
+
+    def __init__(self, id, metadata, data=None, refs=None, end=None, index=None):
+        self.id = id
+        self.metadata = metadata
+        self.data = [] if data is None else data
+        self.refs = [] if refs is None else refs
+        self.end = [] if end is None else end
+        self.index = index
+
+    def lines(self):
+        return self.metadata + self.data + self.end
+
+    def tags(self):
+        return parse_tags(self.metadata + self.end)
+
+    def set_tag(self, k, v):
+        if not set_tag_in_lines(self.metadata, k, v) and not set_tag_in_lines(self.end, k, v):
+            indent = self.data[0][:len(self.data[0]) - len(self.data[0].lstrip())] if self.data else '    '
+            self.end.insert(max(len(self.end) - 1, 0), f'{indent}<tag k="{k}" v="{v}"/>\n')
+
+    def reverse(self):
+        self.data.reverse()
+        self.refs.reverse()
+
+    def copy(self, id):
+        metadata = list(self.metadata)
+        metadata[0] = set_attribute(metadata[0], 'id', str(id))
+        return OsmWay(id, metadata, list(self.data), list(self.refs), list(self.end))
+
+
+# Class: OsmMember
+#
+# A <member type="..." ref="..." role="..."/> line of a relation
+#
+class OsmMember:
+    __slots__ = ('type', 'ref', 'role', 'line')
+
+    def __init__(self, line):
+        self.type = get_attribute(line, 'type')
+        self.ref = int(get_attribute(line, 'ref'))
+        self.role = get_attribute(line, 'role') or ''
+        self.line = line
+
+    def set_ref(self, ref):
+        self.line = set_attribute(self.line, 'ref', str(ref))
+        self.ref = int(ref)
+
+    # For members whose fields are already known, like ones read back from a document cache
+    @classmethod
+    def from_parts(cls, type, ref, role, line):
+        member = cls.__new__(cls)
+        member.type = type
+        member.ref = ref
+        member.role = role
+        member.line = line
+        return member
+
+
+# Class: OsmRelation
+#
+# A <relation> element. body holds OsmMember objects for member lines and raw strings for everything else,
+# so the original line order is kept
+#
+class OsmRelation:
+    __slots__ = ('id', 'header', 'body', 'end')
+
+    def __init__(self, id, header, body=None, end=None):
+        self.id = id
+        self.header = header
+        self.body = [] if body is None else body
+        self.end = [] if end is None else end
+
+    @property
+    def members(self):
+        return [item for item in self.body if isinstance(item, OsmMember)]
+
+    def way_members(self):
+        return [member for member in self.body if isinstance(member, OsmMember) and member.type == 'way']
+
+    def tags(self):
+        return parse_tags(item for item in self.body if isinstance(item, str))
+
+    def is_lanelet(self):
+        tags = self.tags()
+        if 'type' in tags:
+            return tags['type'] == 'lanelet'
+        roles = [member.role for member in self.way_members()]
+        return 'left' in roles and 'right' in roles
+
+    # (left, right) boundary way ids, falling back to the first two way members, or None
+    def boundaries(self):
+        ways = self.way_members()
+        roles = {member.role: member.ref for member in ways}
+        if 'left' in roles and 'right' in roles:
+            return roles['left'], roles['right']
+        if len(ways) >= 2:
+            return ways[0].ref, ways[1].ref
+        return None
+
+    def is_regulatory_element(self):
+        return self.tags().get('type') == 'regulatory_element'
+
+    def copy(self, id):
+        return OsmRelation(id, set_attribute(self.header, 'id', str(id)),
+                           [item if isinstance(item, str) else OsmMember(item.line) for item in self.body],
+                           list(self.end))
+
+    # With keep, a {kind: ids} dict, members referencing anything outside keep are left out
+    def lines(self, keep=None):
+        if keep is None:
+            return [self.header] + [item if isinstance(item, str) else item.line for item in self.body] + self.end
+        return [self.header] + [item if isinstance(item, str) else item.line for item in self.body
+                                if isinstance(item, str) or item.ref in keep.get(item.type, ())] + self.end
+
+
+# Function: get_attribute
+#
+# Value of an attribute of the element on a line, in any position and with either quote style, or None
+#
+def get_attribute(line, name):
+    match = ATTRIBUTES[name].search(line)
+    return None if match is None else match.group(3)
+
+
+# Replaces the value of an attribute, keeping its quotes. The line is returned unchanged if it doesn't have one
+def set_attribute(line, name, value):
+    return ATTRIBUTES[name].sub(lambda match: match.group(1) + match.group(2) + value + match.group(2), line,
+                                count=1)
+
+
+# True if line opens the element of the given kind, NODE_START, WAY_START or RELATION_START, with the given id
+def is_element_line(line, start, id):
+    return line.lstrip().startswith(start) and get_attribute(line, 'id') == str(id)
+
+
+def parse_tags(lines):
+    tags = {}
+    for line in lines:
+        if line.lstrip().startswith(TAG_START):
+            tags[get_attribute(line, 'k')] = get_attribute(line, 'v')
+    return tags
+
+
+def set_tag_in_lines(lines, k, v):
+    for i, line in enumerate(lines):
+        if line.lstrip().startswith(TAG_START) and get_attribute(line, 'k') == k:
+            lines[i] = set_attribute(line, 'v', v)
+            return True
+    return False
+
+
+# Class: NodeStore
+#
+# Node coordinates held in contiguous arrays sorted by id, so the coordinates of a whole way can be gathered
+# with a single searchsorted and fancy-indexing call instead of one lookup per node
+#
+# Parameters:
+#
+#    ids - node ids, in any order
+#    lats - latitude of each node
+#    lons - longitude of each node
+#
+class NodeStore:
+
+    def __init__(self, ids, lats, lons):
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        self.ids = ids[order]
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lons = np.asarray(lons, dtype=np.float64)[order]
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        count = len(nodes)
+        ids = np.fromiter(nodes.keys(), dtype=np.int64, count=count)
+        lats = np.fromiter((node.lat for node in nodes.values()), dtype=np.float64, count=count)
+        lons = np.fromiter((node.lon for node in nodes.values()), dtype=np.float64, count=count)
+        return cls(ids, lats, lons)
+
+    # One store holding the nodes of several, a later store winning for an id in more than one like dict updates do
+    @classmethod
+    def concatenate(cls, stores):
+        ids = np.concatenate([store.ids for store in stores])
+        lats = np.concatenate([store.lats for store in stores])
+        lons = np.concatenate([store.lons for store in stores])
+        unique_ids, last = np.unique(ids[::-1], return_index=True)
+        if len(unique_ids) != len(ids):
+            keep = len(ids) - 1 - last
+            ids, lats, lons = ids[keep], lats[keep], lons[keep]
+        return cls(ids, lats, lons)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+        return (self.ids[rows] == ids) if len(self.ids) else np.zeros(ids.shape, dtype=bool)
+
+    # Row of each id in the arrays, raises KeyError if any id isn't a node
+    def rows(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        found = self.contains(ids)
+        if not np.all(found):
+            raise KeyError(f'unknown node ids {ids[~found][:10].tolist()}')
+        return np.searchsorted(self.ids, ids)
+
+    def lat_lon(self, ids):
+        rows = self.rows(ids)
+        return self.lats[rows], self.lons[rows]
+
+
+# Class: TransverseMercator
+#
+# The transverse Mercator projection a lanelet2 <geoReference> (+proj=tmerc) describes, on the WGS84 ellipsoid.
+# Uses the Krueger series, which is accurate to well under a mm within a few thousand km of lon_0, and works on
+# whole arrays at once
+#
+# Parameters:
+#
+#    lat_0, lon_0 - origin of the projection in degrees
+#    k_0 - scale factor on the central meridian
+#    x_0, y_0 - false easting and northing in m
+#
+class TransverseMercator:
+
+    a = 6378137.0
+    f = 1 / 298.257223563
+
+    def __init__(self, lat_0, lon_0, k_0=1.0, x_0=0.0, y_0=0.0):
+        self.lat_0 = float(lat_0)
+        self.lon_0 = float(lon_0)
+        self.k_0 = float(k_0)
+        self.x_0 = float(x_0)
+        self.y_0 = float(y_0)
+
+        n = self.f / (2 - self.f)
+        self._n = n
+        self._scale = self.k_0 * self.a / (1 + n) * (1 + n**2 / 4 + n**4 / 64)
+        self._alpha = np.array([n/2 - 2*n**2/3 + 5*n**3/16 + 41*n**4/180,
+                                13*n**2/48 - 3*n**3/5 + 557*n**4/1440,
+                                61*n**3/240 - 103*n**4/140,
+                                49561*n**4/161280])
+        self._beta = np.array([n/2 - 2*n**2/3 + 37*n**3/96 - n**4/360,
+                               n**2/48 + n**3/15 - 437*n**4/1440,
+                               17*n**3/480 - 37*n**4/840,
+                               4397*n**4/161280])
+        self._delta = np.array([2*n - 2*n**2/3 - 2*n**3 + 116*n**4/45,
+                                7*n**2/3 - 8*n**3/5 - 227*n**4/45,
+                                56*n**3/15 - 136*n**4/35,
+                                4279*n**4/630])
+        self._xi_0, _ = self._xi_eta(np.array([self.lat_0]), np.array([self.lon_0]))
+
+    # The projection a <geoReference> line describes, or None if it doesn't give lat_0 and lon_0
+    @classmethod
+    def from_georeference(cls, line):
+        parameters = dict(GEO_PARAMETER.findall(line))
+        if 'lat_0' not in parameters or 'lon_0' not in parameters:
+            return None
+        return cls(float(parameters['lat_0']), float(parameters['lon_0']),
+                   float(parameters.get('k_0', parameters.get('k', 1.0))),
+                   float(parameters.get('x_0', 0.0)), float(parameters.get('y_0', 0.0)))
+
+    def _xi_eta(self, lats, lons):
+        phi = np.radians(np.asarray(lats, dtype=np.float64))
+        lam = np.radians(np.asarray(lons, dtype=np.float64) - self.lon_0)
+        e = 2 * np.sqrt(self._n) / (1 + self._n)
+        t = np.sinh(np.arctanh(np.sin(phi)) - e * np.arctanh(e * np.sin(phi)))
+        xi_prime = np.arctan2(t, np.cos(lam))
+        eta_prime = np.arctanh(np.sin(lam) / np.sqrt(1 + t**2))
+        xi, eta = xi_prime.copy(), eta_prime.copy()
+        for j, alpha in enumerate(self._alpha, 1):
+            xi += alpha * np.sin(2*j*xi_prime) * np.cosh(2*j*eta_prime)
+            eta += alpha * np.cos(2*j*xi_prime) * np.sinh(2*j*eta_prime)
+        return xi, eta
+
+    # Projects latitudes and longitudes to x (east) and y (north) in m
+    def project(self, lats, lons):
+        xi, eta = self._xi_eta(lats, lons)
+        return self.x_0 + self._scale * eta, self.y_0 + self._scale * (xi - self._xi_0[0])
+
+    # Inverse of project, x and y in m back to latitudes and longitudes
+    def unproject(self, x, y):
+        xi = (np.asarray(y, dtype=np.float64) - self.y_0) / self._scale + self._xi_0[0]
+        eta = (np.asarray(x, dtype=np.float64) - self.x_0) / self._scale
+        xi_prime, eta_prime = xi.copy(), eta.copy()
+        for j, beta in enumerate(self._beta, 1):
+            xi_prime -= beta * np.sin(2*j*xi) * np.cosh(2*j*eta)
+            eta_prime -= beta * np.cos(2*j*xi) * np.sinh(2*j*eta)
+        chi = np.arcsin(np.sin(xi_prime) / np.cosh(eta_prime))
+        phi = chi.copy()
+        for j, delta in enumerate(self._delta, 1):
+            phi += delta * np.sin(2*j*chi)
+        lam = np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+        return np.degrees(phi), self.lon_0 + np.degrees(lam)
+
+    # Offset in degrees that moves the origin by offset_x, offset_y m
+    def offset_to_degrees(self, offset_x, offset_y):
+        lat, lon = self.unproject(np.array([self.x_0 + offset_x]), np.array([self.y_0 + offset_y]))
+        return float(lat[0]) - self.lat_0, float(lon[0]) - self.lon_0
+
+
+# Class: WayTable
+#
+# The node lists of many ways as one ragged array: the refs of the way in row i are refs[offsets[i]:offsets[i + 1]]
+#
+# Parameters:
+#
+#    ids - way id of each row
+#    offsets - start of each row in refs, plus one final entry for the end of the last row
+#    refs - node ids of every row, concatenated
+#
+class WayTable:
+
+    def __init__(self, ids, offsets, refs):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.refs = np.asarray(refs, dtype=np.int64)
+        self._order = np.argsort(self.ids, kind='stable')
+
+    @classmethod
+    def from_ways(cls, ways, way_ids=None):
+        if way_ids is None:
+            selected = list(ways.values())
+        else:
+            selected = [ways[int(way_id)] for way_id in way_ids]
+        lengths = np.fromiter((len(way.refs) for way in selected), dtype=np.int64, count=len(selected))
+        offsets = np.zeros(len(selected) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        refs = np.fromiter(itertools.chain.from_iterable(way.refs for way in selected), dtype=np.int64,
+                           count=int(offsets[-1]))
+        ids = np.fromiter((way.id for way in selected), dtype=np.int64, count=len(selected))
+        return cls(ids, offsets, refs)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # Row of each way id, raises KeyError if any id isn't in the table
+    def rows(self, way_ids):
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        sorted_ids = self.ids[self._order]
+        positions = np.minimum(np.searchsorted(sorted_ids, way_ids), max(len(sorted_ids) - 1, 0))
+        found = (sorted_ids[positions] == way_ids) if len(sorted_ids) else np.zeros(way_ids.shape, dtype=bool)
+        if not np.all(found):
+            raise KeyError(f'unknown way ids {way_ids[~found][:10].tolist()}')
+        return self._order[positions]
+
+    def get_refs(self, way_id):
+        row = self.rows([way_id])[0]
+        return self.refs[self.offsets[row]:self.offsets[row + 1]]
+
+
+# Class: WayLengths
+#
+# Output of compute_way_lengths. Per-node arrays line up with way_table.refs
+#
+# Members:
+#
+#    way_table - The WayTable the lengths were computed for
+#    segment_lengths - Distance in m from the previous node of the same way, 0 for the first node
+#    cumulative_lengths - Distance in m along the way up to each node
+#    totals - Length in m of each way
+#    too_close - True for the nodes find_too_close_nodes flags, the ones OsmDocument.compute_way_length reports
+#
+class WayLengths:
+
+    def __init__(self, way_table, segment_lengths, cumulative_lengths, totals, too_close):
+        self.way_table = way_table
+        self.segment_lengths = segment_lengths
+        self.cumulative_lengths = cumulative_lengths
+        self.totals = totals
+        self.too_close = too_close
+
+    # {point: way} for every too close point
+    def close_points(self):
+        way_of_ref = np.repeat(self.way_table.ids, self.way_table.lengths())
+        return dict(zip(self.way_table.refs[self.too_close].tolist(), way_of_ref[self.too_close].tolist()))
+
+
+# Function: compute_way_lengths
+#
+# Computes segment, cumulative and total lengths of every way in a WayTable at once
+#
+# Parameters:
+#
+#    node_store - NodeStore holding the coordinates of every referenced node
+#    way_table - WayTable of the ways to measure
+#    lat_to_m - meters per degree of latitude, only used without local_xy
+#    lon_to_m - meters per degree of longitude, only used without local_xy
+#    local_xy - (x, y) in m of every node in node_store order, see OsmDocument.get_local_xy
+#
+# Returns:
+#
+#    WayLengths
+#
+def compute_way_lengths(node_store, way_table, lat_to_m=None, lon_to_m=None, too_close_dist=2.0, local_xy=None):
+    if local_xy is not None:
+        rows = node_store.rows(way_table.refs)
+        ys, xs = local_xy[1][rows], local_xy[0][rows]
+    else:
+        lats, lons = node_store.lat_lon(way_table.refs)
+        ys, xs = lat_to_m * lats, lon_to_m * lons
+    lengths = way_table.lengths()
+    starts = way_table.offsets[:-1][lengths > 0]
+
+    segment_lengths = np.zeros(len(way_table.refs))
+    if len(segment_lengths) > 1:
+        segment_lengths[1:] = np.hypot(np.diff(ys), np.diff(xs))
+    # The step into the first node of a way comes from the end of the previous way, so it doesn't count
+    segment_lengths[starts] = 0.0
+
+    cumulative_lengths = np.cumsum(segment_lengths)
+    cumulative_lengths -= np.repeat(cumulative_lengths[starts], lengths[lengths > 0])
+
+    totals = np.zeros(len(way_table))
+    totals[lengths > 0] = cumulative_lengths[way_table.offsets[1:][lengths > 0] - 1]
+
+    too_close = find_too_close_nodes(xs, ys, way_table, segment_lengths, too_close_dist)
+    return WayLengths(way_table, segment_lengths, cumulative_lengths, totals, too_close)
+
+
+# Function: find_too_close_nodes
+#
+# The too close rule of OsmDocument.compute_way_length for every way at once. Each way is walked in from both
+# ends, from the first node to before the middle and from the last node back to just before the middle, and a node
+# closer than too_close_dist to the last node kept on that walk is flagged and skipped. A node can only be flagged
+# after a short step between neighbours, so only ways with one are walked. The walk goes one position at a time,
+# across all of those ways together
+#
+# Parameters:
+#
+#    xs, ys - coordinates in m of way_table.refs
+#    way_table - WayTable of the ways
+#    segment_lengths - distance of each node from the previous one, see WayLengths
+#    too_close_dist - distance in m
+#
+# Returns:
+#
+#    Boolean array over way_table.refs
+#
+def find_too_close_nodes(xs, ys, way_table, segment_lengths, too_close_dist=2.0):
+    too_close = np.zeros(len(way_table.refs), dtype=bool)
+    lengths = way_table.lengths()
+    short = segment_lengths < too_close_dist
+    short[way_table.offsets[:-1][lengths > 0]] = False
+    short_counts = np.concatenate([[0], np.cumsum(short)])
+    candidates = np.nonzero(short_counts[way_table.offsets[1:]] > short_counts[way_table.offsets[:-1]])[0]
+    if len(candidates) == 0:
+        return too_close
+
+    starts, counts = way_table.offsets[:-1][candidates], lengths[candidates]
+    # The forward walk covers 1 .. n // 2 - 1, the backward walk n - 2 down to n // 2 - 1
+    for origins, step_counts, direction in ((starts, counts // 2 - 1, 1),
+                                            (starts + counts - 1, counts - counts // 2, -1)):
+        kept_x, kept_y = xs[origins], ys[origins]
+        for step in range(1, int(step_counts.max(initial=0)) + 1):
+            active = np.nonzero(step_counts >= step)[0]
+            positions = origins[active] + direction * step
+            close = np.hypot(xs[positions] - kept_x[active], ys[positions] - kept_y[active]) < too_close_dist
+            too_close[positions[close]] = True
+            moved, kept = active[~close], positions[~close]
+            kept_x[moved], kept_y[moved] = xs[kept], ys[kept]
+    return too_close
+
+
+# Class: LaneletLengths
+#
+# Output of compute_lanelet_lengths, one entry per lanelet
+#
+# Members:
+#
+#    lanelet_ids - The lanelets
+#    left, right - Boundary way ids
+#    left_lengths, right_lengths - Length in m of each boundary
+#    lengths - Average length in m of the two boundaries
+#    splits - Recommended number of splits
+#    way_lengths - WayLengths of the boundaries, for the per-node data
+#
+class LaneletLengths:
+
+    def __init__(self, lanelet_ids, left, right, left_lengths, right_lengths, lengths, splits, way_lengths):
+        self.lanelet_ids = lanelet_ids
+        self.left = left
+        self.right = right
+        self.left_lengths = left_lengths
+        self.right_lengths = right_lengths
+        self.lengths = lengths
+        self.splits = splits
+        self.way_lengths = way_lengths
+
+    def close_points(self):
+        return self.way_lengths.close_points()
+
+
+# Function: compute_lanelet_lengths
+#
+# Computes the length of every lanelet at once, along with how many times it should be split so the pieces are
+# about split_dist long. A lanelet less than a third of split_dist over a multiple isn't split again
+#
+# Parameters:
+#
+#    node_store - NodeStore holding the coordinates of every boundary node
+#    way_table - WayTable holding at least every boundary way
+#    lanelet_ids, left, right - Arrays of lanelets and their left and right boundary ways
+#    lat_to_m - meters per degree of latitude, only used without local_xy
+#    lon_to_m - meters per degree of longitude, only used without local_xy
+#    split_dist - Target lanelet length in m
+#    local_xy - (x, y) in m of every node in node_store order, see OsmDocument.get_local_xy
+#
+# Returns:
+#
+#    LaneletLengths
+#
+def compute_lanelet_lengths(node_store, way_table, lanelet_ids, left, right, lat_to_m=None, lon_to_m=None,
+                            split_dist=150.0, local_xy=None):
+    way_lengths = compute_way_lengths(node_store, way_table, lat_to_m, lon_to_m, local_xy=local_xy)
+    left_lengths = way_lengths.totals[way_table.rows(left)]
+    right_lengths = way_lengths.totals[way_table.rows(right)]
+    lengths = (left_lengths + right_lengths) / 2
+
+    splits = (lengths // split_dist).astype(np.int64)
+    splits[(splits > 0) & (lengths % split_dist < split_dist / 3)] -= 1
+    return LaneletLengths(np.asarray(lanelet_ids, dtype=np.int64), np.asarray(left, dtype=np.int64),
+                          np.asarray(right, dtype=np.int64), left_lengths, right_lengths, lengths, splits,
+                          way_lengths)
+
+
+# Function: find_split_indices
+#
+# Finds where to cut ways so each piece covers a given fraction of its length, for many cuts at once. The cumulative
+# lengths are offset per way so one searchsorted covers every way
+#
+# Parameters:
+#
+#    way_lengths - WayLengths of the ways
+#    way_ids - way to cut, one per cut
+#    fractions - fraction of the way's length to cut at, one per cut
+#
+# Returns:
+#
+#    Index into each way's nodes of the node nearest the fraction, kept off the first and last node. -1 for ways with
+#    no node between their ends, which can't be cut
+#
+def find_split_indices(way_lengths, way_ids, fractions):
+    way_table = way_lengths.way_table
+    lengths = way_table.lengths()
+    rows = way_table.rows(way_ids)
+    scale = (float(way_lengths.totals.max()) if len(way_table) else 0.0) + 1.0
+    keys = way_lengths.cumulative_lengths + np.repeat(np.arange(len(way_table)), lengths) * scale
+    targets = way_lengths.totals[rows] * np.asarray(fractions, dtype=np.float64) + rows * scale
+    after = np.minimum(np.searchsorted(keys, targets), len(keys) - 1)
+    before = np.maximum(after - 1, 0)
+    nearest = np.where(np.abs(keys[before] - targets) < np.abs(keys[after] - targets), before, after)
+    indices = np.clip(nearest - way_table.offsets[rows], 1, np.maximum(lengths[rows] - 2, 1))
+    indices[lengths[rows] < 3] = -1
+    return indices
+
+
+# Class: GridIndex
+#
+# Uniform grid over the bounding boxes of many items, e.g. projected nodes (boxes of zero size) or lanelets. Each
+# item is listed in every cell its box touches, with the cells kept as sorted keys over one array of item rows, so a
+# query is a searchsorted over the cells it covers followed by an exact test on the candidates
+#
+# Parameters:
+#
+#    ids - id of each item
+#    min_x, min_y, max_x, max_y - bounding box of each item in m
+#    cell_size - side of a cell in m. Defaults to the median box size, or for points to about two points per cell
+#
+class GridIndex:
+
+    def __init__(self, ids, min_x, min_y, max_x, max_y, cell_size=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.min_x = np.asarray(min_x, dtype=np.float64)
+        self.min_y = np.asarray(min_y, dtype=np.float64)
+        self.max_x = np.asarray(max_x, dtype=np.float64)
+        self.max_y = np.asarray(max_y, dtype=np.float64)
+
+        if len(self.ids) == 0:
+            self.cell_size = 1.0 if cell_size is None else float(cell_size)
+            self.origin_x = self.origin_y = 0.0
+            self.columns = self.rows = 0
+            self.cell_keys = np.zeros(0, dtype=np.int64)
+            self.cell_starts = np.zeros(1, dtype=np.int64)
+            self.items = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin_x = float(self.min_x.min())
+        self.origin_y = float(self.min_y.min())
+        if cell_size is None:
+            sizes = np.maximum(self.max_x - self.min_x, self.max_y - self.min_y)
+            cell_size = float(np.median(sizes))
+            if cell_size <= 0:
+                area = (float(self.max_x.max()) - self.origin_x) * (float(self.max_y.max()) - self.origin_y)
+                cell_size = np.sqrt(2 * area / len(self.ids))
+        self.cell_size = max(float(cell_size), 1e-6)
+        self.columns = self.rows = 0
+
+        first_x, first_y = self._cells(self.min_x, self.min_y)
+        last_x, last_y = self._cells(self.max_x, self.max_y)
+        self.columns = int(last_x.max()) + 1
+        self.rows = int(last_y.max()) + 1
+
+        # One entry per (item, cell) pair, walking each box's cells row by row
+        spans_y = last_y - first_y + 1
+        counts = (last_x - first_x + 1) * spans_y
+        items = np.repeat(np.arange(len(self.ids)), counts)
+        steps = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = first_x[items] + steps // spans_y[items]
+        cell_y = first_y[items] + steps % spans_y[items]
+        keys = cell_x * self.rows + cell_y
+
+        order = np.argsort(keys, kind='stable')
+        self.cell_keys, starts = np.unique(keys[order], return_index=True)
+        self.cell_starts = np.append(starts, len(keys)).astype(np.int64)
+        self.items = items[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Grid cell of each coordinate, clipped to the grid
+    def _cells(self, x, y):
+        cell_x = np.floor((np.asarray(x, dtype=np.float64) - self.origin_x) / self.cell_size).astype(np.int64)
+        cell_y = np.floor((np.asarray(y, dtype=np.float64) - self.origin_y) / self.cell_size).astype(np.int64)
+        if self.columns:
+            cell_x = np.clip(cell_x, 0, self.columns - 1)
+            cell_y = np.clip(cell_y, 0, self.rows - 1)
+        return cell_x, cell_y
+
+    # Rows of the items whose box intersects the query box
+    def box_rows(self, min_x, min_y, max_x, max_y):
+        if len(self.ids) == 0 or min_x > max_x or min_y > max_y:
+            return np.zeros(0, dtype=np.int64)
+        (first_x, first_y), (last_x, last_y) = self._cells(min_x, min_y), self._cells(max_x, max_y)
+        cell_x = np.arange(int(first_x), int(last_x) + 1)
+        cell_y = np.arange(int(first_y), int(last_y) + 1)
+        if len(cell_x) * len(cell_y) >= len(self.cell_keys):
+            # The query covers most of the grid, testing every item is cheaper than walking the cells
+            candidates = np.arange(len(self.ids))
+        else:
+            keys = (cell_x[:, None] * self.rows + cell_y).ravel()
+            positions = np.minimum(np.searchsorted(self.cell_keys, keys), len(self.cell_keys) - 1)
+            positions = positions[self.cell_keys[positions] == keys]
+            starts, ends = self.cell_starts[positions], self.cell_starts[positions + 1]
+            counts = ends - starts
+            slots = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+            candidates = np.unique(self.items[slots])
+        inside = ((self.min_x[candidates] <= max_x) & (self.max_x[candidates] >= min_x) &
+                  (self.min_y[candidates] <= max_y) & (self.max_y[candidates] >= min_y))
+        return candidates[inside]
+
+    # Rows of the items whose box is within radius m of (x, y), and the distance to each box
+    def radius_rows(self, x, y, radius):
+        rows = self.box_rows(x - radius, y - radius, x + radius, y + radius)
+        dx = np.maximum(np.maximum(self.min_x[rows] - x, x - self.max_x[rows]), 0.0)
+        dy = np.maximum(np.maximum(self.min_y[rows] - y, y - self.max_y[rows]), 0.0)
+        distances = np.hypot(dx, dy)
+        close = distances <= radius
+        return rows[close], distances[close]
+
+    # Sorted ids of the items whose box intersects the query box
+    def query_box(self, min_x, min_y, max_x, max_y):
+        return np.sort(self.ids[self.box_rows(min_x, min_y, max_x, max_y)])
+
+    # Sorted ids of the items whose box is within radius m of (x, y)
+    def query_radius(self, x, y, radius):
+        rows, _ = self.radius_rows(x, y, radius)
+        return np.sort(self.ids[rows])
+
+
+# Function: polygon_distances
+#
+# Distance from a point to many closed polygons given as one array of edges, 0 for polygons containing the point
+# (even-odd rule)
+#
+# Parameters:
+#
+#    x, y - the point
+#    x_1, y_1, x_2, y_2 - start and end of every edge
+#    owners - polygon index of each edge, 0..count - 1
+#    count - number of polygons
+#
+# Returns:
+#
+#    Array of count distances, inf for polygons without edges
+#
+def polygon_distances(x, y, x_1, y_1, x_2, y_2, owners, count):
+    dx, dy = x_2 - x_1, y_2 - y_1
+    squared = dx**2 + dy**2
+    t = np.clip(((x - x_1) * dx + (y - y_1) * dy) / np.where(squared > 0, squared, 1.0), 0.0, 1.0)
+    edge_distances = np.hypot(x_1 + t * dx - x, y_1 + t * dy - y)
+    distances = np.full(count, np.inf)
+    np.minimum.at(distances, owners, edge_distances)
+
+    crosses = (y_1 > y) != (y_2 > y)
+    crossing_x = x_1[crosses] + (y - y_1[crosses]) * dx[crosses] / dy[crosses]
+    crossings = np.bincount(owners[crosses][crossing_x > x], minlength=count)
+    distances[crossings % 2 == 1] = 0.0
+    return distances
+
+
+# Function: find_point_clusters
+#
+# Groups points that are within tolerance of each other (chained, so a cluster can be longer than tolerance).
+# Points are hashed into a grid of tolerance sized cells, and only points in the same or neighbouring cells are
+# compared, so this is roughly linear in the number of points
+#
+# Parameters:
+#
+#    x, y - point coordinates in m
+#    tolerance - merge distance in m
+#
+# Returns:
+#
+#    An array giving, for each point, the index of the lowest-indexed point in its cluster
+#
+def find_point_clusters(x, y, tolerance):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    parent = np.arange(len(x))
+    if len(x) < 2:
+        return parent
+
+    cell_x = np.floor(x / tolerance).astype(np.int64)
+    cell_y = np.floor(y / tolerance).astype(np.int64)
+    cell_x -= cell_x.min()
+    cell_y -= cell_y.min()
+    width = int(cell_y.max()) + 2
+    keys = cell_x * width + cell_y
+
+    order = np.argsort(keys, kind='stable')
+    cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    def find(i):
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    # Each cell is compared with itself and the neighbours ahead of it, so every pair of cells is checked once
+    for dx, dy in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        targets = cells + dx * width + dy
+        positions = np.minimum(np.searchsorted(cells, targets), len(cells) - 1)
+        hits = (counts > 1) if (dx, dy) == (0, 0) else (cells[positions] == targets)
+        for a, b in zip(np.nonzero(hits)[0].tolist(), positions[hits].tolist()):
+            points_a = order[starts[a]:starts[a] + counts[a]]
+            points_b = order[starts[b]:starts[b] + counts[b]]
+            close = (x[points_a, None] - x[points_b]) ** 2 + (y[points_a, None] - y[points_b]) ** 2 \
+                <= tolerance ** 2
+            if a == b:
+                close = np.triu(close, 1)
+            for i, j in zip(*np.nonzero(close)):
+                root_i, root_j = find(points_a[i]), find(points_b[j])
+                if root_i != root_j:
+                    parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(len(parent))])
+
+
+# Class: DoubledBoundary
+#
+# A way that more than one lanelet uses with the same role, see OsmDocument.get_doubled_centerlines
+#
+# Members:
+#
+#    way - The doubled way
+#    lanelets - Every lanelet using the way as a left or right boundary
+#    roles - The role each of those lanelets gives the way
+#    other_boundaries - The other boundary of each of those lanelets
+#
+class DoubledBoundary:
+
+    def __init__(self, way, lanelets, roles, other_boundaries):
+        self.way = way
+        self.lanelets = lanelets
+        self.roles = roles
+        self.other_boundaries = other_boundaries
+
+    # From the [doubled boundary, lanelet 1, other boundary 1, lanelet 2, other boundary 2] lists older code used
+    @classmethod
+    def from_list(cls, doubled_boundary_data):
+        [doubled_boundary, lanelet1, lanelet1_boundary, lanelet2, lanelet2_boundary] = doubled_boundary_data
+        return cls(int(doubled_boundary), [int(lanelet1), int(lanelet2)], [None, None],
+                   [int(lanelet1_boundary), int(lanelet2_boundary)])
+
+    def to_list(self):
+        return [self.way, self.lanelets[0], self.other_boundaries[0], self.lanelets[1], self.other_boundaries[1]]
+
+    def __repr__(self):
+        return f'DoubledBoundary(way={self.way}, lanelets={self.lanelets}, roles={self.roles}, ' \
+               f'other_boundaries={self.other_boundaries})'
+
+
+# Function: compute_way_headings
+#
+# Heading of the middle segment of every way in a WayTable, the same segment compute_lanelet_boundary_angle uses.
+# With local_xy, (x, y) of every node in node_store order, the heading is measured in the projected plane
+#
+# Returns:
+#
+#    Array of atan2(d north, d east) per row, nan for ways with fewer than 2 nodes
+#
+def compute_way_headings(node_store, way_table, local_xy=None):
+    lengths = way_table.lengths()
+    headings = np.full(len(way_table), np.nan)
+    valid = lengths >= 2
+    first = way_table.offsets[:-1][valid] + (lengths[valid] - 1) // 2
+    if local_xy is not None:
+        rows_1, rows_2 = node_store.rows(way_table.refs[first]), node_store.rows(way_table.refs[first + 1])
+        headings[valid] = np.arctan2(local_xy[1][rows_2] - local_xy[1][rows_1],
+                                     local_xy[0][rows_2] - local_xy[0][rows_1])
+    else:
+        lats_1, lons_1 = node_store.lat_lon(way_table.refs[first])
+        lats_2, lons_2 = node_store.lat_lon(way_table.refs[first + 1])
+        headings[valid] = np.arctan2(lats_2 - lats_1, lons_2 - lons_1)
+    return headings
+
+
+# Function: angle_difference
+#
+# Absolute difference between headings in radians, wrapped into [0, pi]
+#
+def angle_difference(a, b):
+    return np.abs((np.asarray(a) - np.asarray(b) + np.pi) % (2 * np.pi) - np.pi)
+
+
+# Class: ReferenceCounter
+#
+# How many times each element is referenced: nodes by ways and node members, ways and relations by relation
+# members. Ids whose count drops to zero are queued in pending, so OsmDocument.collect_garbage can clean up after
+# an edit without rescanning the map
+#
+class ReferenceCounter:
+
+    def __init__(self):
+        self.counts = {'node': collections.Counter(), 'way': collections.Counter(), 'relation': collections.Counter()}
+        self.pending = set()
+
+    @classmethod
+    def from_document(cls, doc):
+        counter = cls()
+        for way in doc.ways.values():
+            counter.counts['node'].update(way.refs)
+        for relation in doc.relations.values():
+            for member in relation.members:
+                counter.counts.setdefault(member.type, collections.Counter())[member.ref] += 1
+        return counter
+
+    def count(self, kind, id):
+        return self.counts.get(kind, {}).get(id, 0)
+
+    def add(self, kind, ids):
+        self.counts.setdefault(kind, collections.Counter()).update(ids)
+
+    def drop(self, kind, ids):
+        counts = self.counts.setdefault(kind, collections.Counter())
+        for id in ids:
+            counts[id] -= 1
+            if counts[id] <= 0:
+                del counts[id]
+                self.pending.add((kind, id))
+
+
+# Class: IdAllocator
+#
+# Hands out ids no element of the document uses. Nodes, ways and relations share one id space, as in
+# lanelet2 maps, so one counter covers all of them
+#
+# Parameters:
+#
+#    largest - The largest id already in use
+#
+class IdAllocator:
+
+    def __init__(self, largest=0):
+        self.next_id = int(largest) + 1
+
+    @property
+    def largest(self):
+        return self.next_id - 1
+
+    # Makes sure id is never handed out, for elements added with an id chosen elsewhere
+    def observe(self, id):
+        if id >= self.next_id:
+            self.next_id = int(id) + 1
+
+    def allocate(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    # A block of count consecutive fresh ids, for bulk operations
+    def reserve(self, count):
+        block = range(self.next_id, self.next_id + count)
+        self.next_id += count
+        return block
+
+
+# Class: LaneletGraph
+#
+# Which lanelets can be driven into from which. edges[a][b] is how b is reached from a: 'successor', or 'left' /
+# 'right' for a lane change, or whatever label a route DOT file gave the edge
+#
+class LaneletGraph:
+
+    def __init__(self):
+        self.edges = {}
+
+    def add_lanelet(self, lanelet):
+        self.edges.setdefault(int(lanelet), {})
+
+    def add_edge(self, a, b, kind='successor'):
+        self.add_lanelet(b)
+        self.edges.setdefault(int(a), {})[int(b)] = kind
+
+    def has_edge(self, a, b):
+        return int(b) in self.edges.get(int(a), ())
+
+    # Function: from_document
+    #
+    # Lanelet b succeeds a when the left and right boundaries of a end on the nodes the boundaries of b start on.
+    # The starts are kept in a hash index, so each lanelet's successors are one lookup. Lanelets sharing a boundary
+    # way are neighbours, and lane_change_subtypes lists the boundary subtypes that can be crossed
+    #
+    @classmethod
+    def from_document(cls, doc, lane_change_subtypes=('dashed',)):
+        graph = cls()
+        lanelet_boundaries = {}
+        for lanelet in doc.get_all_lanelets():
+            graph.add_lanelet(lanelet)
+            boundaries = doc.relations[lanelet].boundaries()
+            if boundaries is not None and boundaries[0] in doc.ways and boundaries[1] in doc.ways:
+                lanelet_boundaries[lanelet] = (doc.ways[boundaries[0]].refs, doc.ways[boundaries[1]].refs)
+
+        starts = {}
+        for lanelet, (left, right) in lanelet_boundaries.items():
+            if left and right:
+                starts.setdefault((left[0], right[0]), []).append(lanelet)
+        for lanelet, (left, right) in lanelet_boundaries.items():
+            if left and right:
+                for successor in starts.get((left[-1], right[-1]), ()):
+                    if successor != lanelet:
+                        graph.add_edge(lanelet, successor, 'successor')
+
+        for lanelet, boundaries in lanelet_boundaries.items():
+            left_id, right_id = doc.relations[lanelet].boundaries()
+            for way_id, side, other_role in ((left_id, 'left', 'right'), (right_id, 'right', 'left')):
+                if doc.ways[way_id].tags().get('subtype') not in lane_change_subtypes:
+                    continue
+                for neighbour, role in doc.get_way_users(way_id):
+                    if role == other_role and neighbour != lanelet and neighbour in lanelet_boundaries:
+                        graph.add_edge(lanelet, neighbour, side)
+        return graph
+
+    # Function: from_dot
+    #
+    # Reads a route graph DOT file, like the one CARMA's route tests write, in one pass. Vertices are lines like
+    # 12[label="5000" lanelet="5000"]; and edges lines like 12->13 [label="Successor"];
+    #
+    @classmethod
+    def from_dot(cls, route_file):
+        graph = cls()
+        vertices = {}
+        edges = []
+        record_file_read(route_file, full_scan=True)
+        with open(route_file) as f:
+            for line in f:
+                edge = DOT_EDGE.match(line)
+                if edge is not None:
+                    edges.append(edge.groups())
+                    continue
+                vertex = DOT_VERTEX.match(line)
+                if vertex is not None:
+                    vertices[vertex.group(1)] = int(vertex.group(2))
+                    graph.add_lanelet(vertex.group(2))
+        for a, b, label in edges:
+            if a in vertices and b in vertices:
+                graph.add_edge(vertices[a], vertices[b], label.lower() if label else 'successor')
+        return graph
+
+    # Index of the first lanelet in sequence that can't be reached from the one before it, or None if the whole
+    # sequence is routable
+    def first_break(self, sequence):
+        sequence = [int(lanelet) for lanelet in sequence]
+        for i in range(1, len(sequence)):
+            if not self.has_edge(sequence[i - 1], sequence[i]):
+                return i
+        return None
+
+    def is_routable(self, sequence):
+        return self.first_break(sequence) is None
+
+    # [(a, b), ...] edges of this graph that other doesn't have
+    def missing_from(self, other):
+        return [(a, b) for a, targets in self.edges.items() for b in targets if not other.has_edge(a, b)]
+
+
+# Class: RoutingGraph
+#
+# A LaneletGraph in compressed sparse row form, weighted for routing: the edges out of lanelet_ids[i] go to
+# lanelet_ids[indices[indptr[i]:indptr[i + 1]]] with the matching weights. Driving on to a successor costs the
+# length of the lanelet being left, a lane change costs lane_change_cost
+#
+# Members:
+#
+#    lanelet_ids - sorted lanelet ids
+#    indptr, indices, weights - CSR edge arrays
+#    fingerprint - map_fingerprint of the map it was built from, if it came from a file
+#    size, mtime - document_cache_key of that file, checked before the fingerprint
+#
+class RoutingGraph:
+
+    def __init__(self, lanelet_ids, indptr, indices, weights, fingerprint='', size=0, mtime=0):
+        self.lanelet_ids = np.asarray(lanelet_ids, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.fingerprint = fingerprint
+        self.size = size
+        self.mtime = mtime
+
+    # lengths - {lanelet: length in m}, lanelets missing from it cost nothing to leave
+    @classmethod
+    def from_lanelet_graph(cls, graph, lengths, lane_change_cost=0.0, fingerprint=''):
+        lanelet_ids = np.array(sorted(graph.edges), dtype=np.int64)
+        counts = np.fromiter((len(graph.edges[lanelet]) for lanelet in lanelet_ids.tolist()), dtype=np.int64,
+                             count=len(lanelet_ids))
+        indptr = np.zeros(len(lanelet_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        targets, weights = [], []
+        for lanelet in lanelet_ids.tolist():
+            for target, kind in graph.edges[lanelet].items():
+                targets.append(target)
+                weights.append(lengths.get(lanelet, 0.0) if kind == 'successor' else lane_change_cost)
+        indices = np.searchsorted(lanelet_ids, np.array(targets, dtype=np.int64))
+        return cls(lanelet_ids, indptr, indices, weights, fingerprint)
+
+    def save(self, path):
+        write_npz_atomic(path, lanelet_ids=self.lanelet_ids, indptr=self.indptr, indices=self.indices,
+                         weights=self.weights, fingerprint=np.array(self.fingerprint), size=np.int64(self.size),
+                         mtime=np.int64(self.mtime))
+
+    @classmethod
+    def load(cls, path):
+        record_file_read(path)
+        with np.load(path) as arrays:
+            size, mtime = (int(arrays['size']), int(arrays['mtime'])) if 'size' in arrays else (0, 0)
+            return cls(arrays['lanelet_ids'], arrays['indptr'], arrays['indices'], arrays['weights'],
+                       str(arrays['fingerprint']), size, mtime)
+
+    def row(self, lanelet):
+        row = int(np.searchsorted(self.lanelet_ids, int(lanelet)))
+        if row >= len(self.lanelet_ids) or self.lanelet_ids[row] != int(lanelet):
+            raise KeyError(f'unknown lanelet {lanelet}')
+        return row
+
+    # Function: shortest_path
+    #
+    # Dijkstra from start to goal
+    #
+    # Returns:
+    #
+    #    ([start, ..., goal], cost in m), or (None, inf) if goal can't be reached
+    #
+    def shortest_path(self, start, goal):
+        start, goal = self.row(start), self.row(goal)
+        distances = np.full(len(self.lanelet_ids), np.inf)
+        previous = np.full(len(self.lanelet_ids), -1, dtype=np.int64)
+        distances[start] = 0.0
+        queue = [(0.0, start)]
+        while queue:
+            distance, row = heapq.heappop(queue)
+            if row == goal:
+                break
+            if distance > distances[row]:
+                continue
+            for edge in range(self.indptr[row], self.indptr[row + 1]):
+                target = self.indices[edge]
+                candidate = distance + self.weights[edge]
+                if candidate < distances[target]:
+                    distances[target] = candidate
+                    previous[target] = row
+                    heapq.heappush(queue, (candidate, int(target)))
+
+        if not np.isfinite(distances[goal]):
+            return None, np.inf
+        path = [goal]
+        while path[-1] != start:
+            path.append(int(previous[path[-1]]))
+        return self.lanelet_ids[path[::-1]].tolist(), float(distances[goal])
+
+
+# Function: map_fingerprint
+#
+# Hash of the contents of an osm file, used to tell whether something cached from it is still valid
+#
+def map_fingerprint(osm_file):
+    digest = hashlib.sha1()
+    record_file_read(osm_file, full_scan=True)
+    with open(osm_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Function: document_cache_key
+#
+# (size, mtime in ns) of an osm file, the cheap part of the key a document cache is checked against
+#
+def document_cache_key(osm_file):
+    stat = os.stat(osm_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Class: ElementIndex
+#
+# Where each element sits in an osm file: byte offset and length of its lines, and the line it starts on. Built with
+# one scan over an mmap of the file, so one-off lookups can seek straight to an element without parsing the map
+#
+# Members:
+#
+#    kinds - index into KINDS of each element, sorted together with ids
+#    ids, offsets, lengths, lines - per element id, byte range and first line
+#    size, mtime - document_cache_key of the file it was built from
+#
+class ElementIndex:
+    KINDS = ('node', 'way', 'relation')
+
+    def __init__(self, kinds, ids, offsets, lengths, lines, size=0, mtime=0):
+        kinds = np.asarray(kinds, dtype=np.int8)
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.lexsort((ids, kinds))
+        self.kinds = kinds[order]
+        self.ids = ids[order]
+        self.offsets = np.asarray(offsets, dtype=np.int64)[order]
+        self.lengths = np.asarray(lengths, dtype=np.int64)[order]
+        self.lines = np.asarray(lines, dtype=np.int64)[order]
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def build(cls, osm_file):
+        kinds, ids, offsets, lengths, lines = [], [], [], [], []
+        size, mtime = document_cache_key(osm_file)
+        record_file_read(osm_file, full_scan=True)
+        with open(osm_file, 'rb') as f:
+            if size == 0:
+                return cls(kinds, ids, offsets, lengths, lines, size, mtime)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                line = 0
+                counted_to = 0
+                position = 0
+                while True:
+                    match = ELEMENT_START.search(data, position)
+                    if match is None:
+                        break
+                    kind = match.group(1)
+                    start = data.rfind(b'\n', 0, match.start()) + 1
+                    tag_end = data.find(b'>', match.end())
+                    if data[tag_end - 1:tag_end] == b'/':
+                        end = tag_end + 1
+                    else:
+                        end = data.find(b'</' + kind + b'>', tag_end) + len(kind) + 3
+                    line_end = data.find(b'\n', end)
+                    end = len(data) if line_end == -1 else line_end + 1
+
+                    line += data[counted_to:start].count(b'\n')
+                    counted_to = start
+                    kinds.append(cls.KINDS.index(kind.decode()))
+                    ids.append(int(match.group(3)))
+                    offsets.append(start)
+                    lengths.append(end - start)
+                    lines.append(line)
+                    position = end
+        return cls(kinds, ids, offsets, lengths, lines, size, mtime)
+
+    def save(self, path):
+        write_npz_atomic(path, kinds=self.kinds, ids=self.ids, offsets=self.offsets, lengths=self.lengths,
+                         lines=self.lines, size=np.int64(self.size), mtime=np.int64(self.mtime))
+
+    @classmethod
+    def load(cls, path):
+        record_file_read(path)
+        with np.load(path) as arrays:
+            return cls(arrays['kinds'], arrays['ids'], arrays['offsets'], arrays['lengths'], arrays['lines'],
+                       int(arrays['size']), int(arrays['mtime']))
+
+    # Row of the element, or None if it isn't in the file
+    def find(self, kind, id):
+        code = self.KINDS.index(kind)
+        low = np.searchsorted(self.kinds, code, side='left')
+        high = np.searchsorted(self.kinds, code, side='right')
+        row = low + np.searchsorted(self.ids[low:high], int(id))
+        if row < high and self.ids[row] == int(id):
+            return int(row)
+        return None
+
+    # Reads just the one element from osm_file, as the OsmNode, OsmWay or OsmRelation parsing would give, or None
+    def read(self, osm_file, kind, id):
+        row = self.find(kind, id)
+        if row is None:
+            return None
+        record_file_read(osm_file, int(self.lengths[row]))
+        with open(osm_file, 'rb') as f:
+            f.seek(self.offsets[row])
+            text = f.read(self.lengths[row]).decode('utf-8')
+        doc = OsmDocument()
+        doc.parse(text.splitlines(keepends=True))
+        element = {'node': doc.nodes, 'way': doc.ways, 'relation': doc.relations}[kind].get(int(id))
+        if isinstance(element, OsmWay) and element.index is not None:
+            element.index += int(self.lines[row])
+        return element
+
+
+# Function: load_element_index
+#
+# The ElementIndex of osm_file, from <osm_file>.index.npz when that was built for the file's current size and
+# mtime, otherwise built and saved there. If the index can't be written, e.g. for a map in a read-only directory,
+# the one built in memory is used, so lookups stay read-only operations
+#
+def load_element_index(osm_file):
+    index_file = osm_file + '.index.npz'
+    size, mtime = document_cache_key(osm_file)
+    if os.path.exists(index_file):
+        try:
+            index = ElementIndex.load(index_file)
+            if index.size == size and index.mtime == mtime:
+                return index
+        except CACHE_READ_ERRORS:
+            pass
+    index = ElementIndex.build(osm_file)
+    try:
+        index.save(index_file)
+    except OSError:
+        pass
+    return index
+
+
+# Function: find_chunk_boundaries
+#
+# Splits an osm file into about chunks byte ranges of similar size, each starting at the start of a line that opens a
+# <node, <way or <relation, so every element falls entirely inside one range
+#
+# Returns:
+#
+#    [(start, end), ...] byte ranges covering the whole file in order
+#
+def find_chunk_boundaries(osm_file, chunks):
+    size = os.path.getsize(osm_file)
+    if size == 0 or chunks <= 1:
+        return [(0, size)]
+    boundaries = [0]
+    record_file_read(osm_file, 0)
+    with open(osm_file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for k in range(1, chunks):
+                match = CHUNK_BOUNDARY.search(data, max(size * k // chunks - 1, boundaries[-1]))
+                if match is None:
+                    break
+                if match.start() + 1 > boundaries[-1]:
+                    boundaries.append(match.start() + 1)
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+# Parses bytes start:end of osm_file into to_arrays form, with the number of lines read. Runs in the worker
+# processes of parse_parallel
+def parse_chunk(osm_file, start, end):
+    record_file_read(osm_file, end - start)
+    with open(osm_file, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode('utf-8')
+    lines = list(io.StringIO(text, newline=None))
+    doc = OsmDocument()
+    doc.parse(lines)
+    return doc.to_arrays(), len(lines)
+
+
+# Function: parse_parallel
+#
+# Parses one large osm file with a pool of worker processes. The file is cut at element boundaries, each chunk is
+# parsed into columnar arrays in a worker, and the arrays are added to the document in file order, so the result is
+# the same as OsmDocument(osm_file). The parent only decodes the text and reads the member columns, the element
+# objects are built when first used (see OsmDocument.from_arrays) and the NodeStore is concatenated from the chunks.
+# With one worker or chunk, or a file under PARALLEL_PARSE_MIN_SIZE, the plain serial parse is faster and is used
+#
+# Parameters:
+#
+#    osm_file - osm file to load
+#    max_workers - number of processes, defaults to one per core
+#    chunks - number of byte ranges, defaults to max_workers
+#
+def parse_parallel(osm_file, max_workers=None, chunks=None):
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if chunks is None:
+        chunks = max_workers
+    if max_workers <= 1 or chunks <= 1 or os.path.getsize(osm_file) < PARALLEL_PARSE_MIN_SIZE:
+        return OsmDocument(osm_file)
+    ranges = find_chunk_boundaries(osm_file, chunks)
+    # The chunks are read in the workers, which aren't instrumented
+    record_file_read(osm_file, full_scan=True)
+
+    doc = OsmDocument()
+    doc.osm_file = osm_file
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(parse_chunk, osm_file, start, end) for start, end in ranges]
+        line_offset = 0
+        for future in futures:
+            arrays, line_count = future.result()
+            doc.from_arrays(arrays, line_offset)
+            line_offset += line_count
+    return doc
+
+
+# Class: DocumentPart
+#
+# The to_arrays output of a document or a chunk of one, kept by OsmDocument.from_arrays until its elements are
+# needed. The text is decoded once, and each kind of element is built from its own range of lines when asked for
+#
+class DocumentPart:
+
+    def __init__(self, arrays, line_offset=0):
+        self.text = arrays['text'].tobytes().decode('utf-8')
+        self.line_offsets = arrays['line_offsets']
+        self.line_offset = line_offset
+        self.ids = {kind: arrays[kind + '_ids'] for kind in ('node', 'way', 'relation')}
+        self.node_lats = arrays['node_lats']
+        self.node_lons = arrays['node_lons']
+        self.node_counts = arrays['node_counts']
+        self.way_index = arrays['way_index']
+        self.way_counts = arrays['way_counts']
+        self.way_refs = arrays['way_refs']
+        self.relation_counts = arrays['relation_counts']
+        self.is_member = arrays['is_member']
+        self.member_types = arrays['member_types'].tolist()
+        self.member_refs = arrays['member_refs'].tolist()
+        self.member_roles = arrays['member_roles'].tolist()
+
+        self.node_start = int(arrays['header_count'])
+        self.way_start = self.node_start + int(self.node_counts.sum())
+        self.relation_start = self.way_start + int(self.way_counts.sum())
+        self.footer_start = self.relation_start + len(self.ids['relation']) + int(self.relation_counts.sum())
+        self.leading_start = self.footer_start + int(arrays['footer_count'])
+
+    def lines(self, start, end):
+        offsets = self.line_offsets[start:end + 1].tolist()
+        text = self.text
+        return [text[line_start:line_end] for line_start, line_end in zip(offsets, offsets[1:])]
+
+    def node_store(self):
+        return NodeStore(self.ids['node'], self.node_lats, self.node_lons)
+
+    def nodes(self):
+        lines = self.lines(self.node_start, self.way_start)
+        nodes, position = {}, 0
+        for id, lat, lon, count in zip(self.ids['node'].tolist(), self.node_lats.tolist(), self.node_lons.tolist(),
+                                       self.node_counts.tolist()):
+            nodes[id] = OsmNode(id, lat, lon, lines[position:position + count])
+            position += count
+        return nodes
+
+    def ways(self):
+        lines = self.lines(self.way_start, self.relation_start)
+        refs = self.way_refs.tolist()
+        ways, position, ref_position = {}, 0, 0
+        for id, index, (metadata_count, data_count, end_count) in zip(
+                self.ids['way'].tolist(), self.way_index.tolist(), self.way_counts.tolist()):
+            data_start = position + metadata_count
+            end_start = data_start + data_count
+            ways[id] = OsmWay(id, lines[position:data_start], lines[data_start:end_start],
+                              refs[ref_position:ref_position + data_count], lines[end_start:end_start + end_count],
+                              None if index < 0 else index + self.line_offset)
+            position = end_start + end_count
+            ref_position += data_count
+        return ways
+
+    def relations(self):
+        lines = self.lines(self.relation_start, self.footer_start)
+        is_member = self.is_member.tolist()
+        members = zip(self.member_types, self.member_refs, self.member_roles)
+        relations, position, body_position = {}, 0, 0
+        for id, (body_count, end_count) in zip(self.ids['relation'].tolist(), self.relation_counts.tolist()):
+            body = [OsmMember.from_parts(*next(members), line) if member else line
+                    for line, member in zip(lines[position + 1:position + 1 + body_count],
+                                            is_member[body_position:body_position + body_count])]
+            end_start = position + 1 + body_count
+            relations[id] = OsmRelation(id, lines[position], body, lines[end_start:end_start + end_count])
+            position = end_start + end_count
+            body_position += body_count
+        return relations
+
+
+# Class: OsmDocument
+#
+# An osm file parsed once into node, way and relation tables keyed by id. Every operation in this module is
+# available as a method that works on the in-memory tables; call save() to write the result back out
+#
+# Parameters:
+#
+#    osm_file - osm file to load, or None for an empty document
+#    cache - read the file through a binary cache kept next to it, see load
+#
+# Members:
+#
+#    nodes, ways, relations - {id: element} tables
+#    way_users - {way id: [(relation id, role), ...]}, which relations use each way and how. Built while parsing
+#    leading - {(kind, id): [lines]}, comments and blank lines between elements, written before the element that
+#              followed them so the file round-trips. They go with the element if it is deleted
+#    ids - IdAllocator for new elements, set up from the largest id once parsing is done
+#
+# Code that edits nodes directly instead of through the methods here should call nodes_changed() afterwards,
+# so the cached NodeStore is rebuilt
+#
+class OsmDocument:
+
+    def __init__(self, osm_file=None, cache=False):
+        self.osm_file = osm_file
+        self.clear()
+        if osm_file is not None:
+            self.load(osm_file, cache)
+
+    # Empties the document, dropping every element and cached table
+    def clear(self):
+        self.header = []
+        self.footer = []
+        self.leading = {}
+        # Parts from from_arrays whose elements haven't been built yet, see _materialize
+        self._pending = {'node': [], 'way': [], 'relation': []}
+        self.nodes = {}
+        self.ways = {}
+        self.relations = {}
+        self.way_users = {}
+        self.ids = IdAllocator()
+        self._node_store = None
+        self._projection = None
+        self._local_xy = None
+        self._node_index = None
+        self._references = None
+
+    # The element tables. Elements from from_arrays are built on first use, see _materialize
+    @property
+    def nodes(self):
+        if self._pending['node']:
+            self._materialize('node')
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self._pending['node'] = []
+        self._nodes = nodes
+
+    @property
+    def ways(self):
+        if self._pending['way']:
+            self._materialize('way')
+        return self._ways
+
+    @ways.setter
+    def ways(self, ways):
+        self._pending['way'] = []
+        self._ways = ways
+
+    @property
+    def relations(self):
+        if self._pending['relation']:
+            self._materialize('relation')
+        return self._relations
+
+    @relations.setter
+    def relations(self, relations):
+        self._pending['relation'] = []
+        self._relations = relations
+
+    # While every node is still in pending parts, the NodeStore is put together from their coordinate columns
+    # without building the nodes
+    @property
+    def node_store(self):
+        if self._node_store is None:
+            parts = self._pending['node']
+            if parts and not self._nodes:
+                self._node_store = NodeStore.concatenate([part.node_store() for part in parts])
+            else:
+                self._node_store = NodeStore.from_nodes(self.nodes)
+        return self._node_store
+
+    def nodes_changed(self):
+        self._node_store = None
+        self._projection = None
+        self._local_xy = None
+        self._node_index = None
+
+    # Starts keeping a ReferenceCounter up to date for this document. Edits that add or drop references should go
+    # through add_way, delete_way, add_relation, delete_relation, set_way_refs and set_member_ref so it, and
+    # way_users, stay correct
+    def enable_reference_counting(self):
+        if self._references is None:
+            self._references = ReferenceCounter.from_document(self)
+        return self._references
+
+    def add_node(self, node):
+        self.nodes[node.id] = node
+        self.ids.observe(node.id)
+        self.nodes_changed()
+
+    def add_way(self, way):
+        self.ways[way.id] = way
+        self.ids.observe(way.id)
+        if self._references is not None:
+            self._references.add('node', way.refs)
+
+    def delete_way(self, way_id):
+        way = self.ways.pop(way_id, None)
+        if way is not None and self._references is not None:
+            self._references.drop('node', way.refs)
+        return way
+
+    def add_relation(self, relation):
+        self.relations[relation.id] = relation
+        self.ids.observe(relation.id)
+        for member in relation.members:
+            if member.type == 'way':
+                self.way_users.setdefault(member.ref, []).append((relation.id, member.role))
+            if self._references is not None:
+                self._references.add(member.type, [member.ref])
+
+    def delete_relation(self, relation_id):
+        relation = self.relations.pop(relation_id, None)
+        if relation is None:
+            return None
+        for member in relation.members:
+            if member.type == 'way':
+                self._remove_way_user(member.ref, relation.id, member.role)
+            if self._references is not None:
+                self._references.drop(member.type, [member.ref])
+        return relation
+
+    def set_way_refs(self, way, refs, data):
+        if self._references is not None:
+            self._references.drop('node', way.refs)
+            self._references.add('node', refs)
+        way.refs = refs
+        way.data = data
+
+    def set_member_ref(self, relation, member, ref):
+        if self._references is not None:
+            self._references.drop(member.type, [member.ref])
+            self._references.add(member.type, [int(ref)])
+        if member.type == 'way':
+            self._remove_way_user(member.ref, relation.id, member.role)
+            self.way_users.setdefault(int(ref), []).append((relation.id, member.role))
+        member.set_ref(ref)
+
+    def _remove_way_user(self, way_id, relation_id, role):
+        users = self.way_users.get(way_id)
+        if users is not None:
+            users.remove((relation_id, role))
+            if not users:
+                del self.way_users[way_id]
+
+    def rebuild_way_users(self):
+        self.way_users = {}
+        for relation in self.relations.values():
+            for member in relation.way_members():
+                self.way_users.setdefault(member.ref, []).append((relation.id, member.role))
+
+    # [(relation id, role), ...] of every relation using the way
+    def get_way_users(self, way_id):
+        return list(self.way_users.get(int(way_id), ()))
+
+    # Function: collect_garbage
+    #
+    # Deletes elements of the given kinds that nothing references. Normally only elements that lost their last
+    # reference since the previous collection are checked, so this is cheap enough to run after every edit.
+    # full=True checks every node and way instead, which is needed once to catch orphans that were already in the
+    # file. Relations are only deleted once they lose their last reference: lanelets and other top-level relations
+    # are never referenced, so they are roots, not garbage. Deleting a way or relation releases its own references,
+    # so orphans cascade within the same call
+    #
+    # Returns:
+    #
+    #    A dict of how many elements of each kind were deleted
+    #
+    def collect_garbage(self, kinds=('node',), full=False):
+        references = self.enable_reference_counting()
+        tables = {'node': self.nodes, 'way': self.ways, 'relation': self.relations}
+        if full:
+            for kind in kinds:
+                if kind == 'relation':
+                    continue
+                counts = references.counts[kind]
+                references.pending.update((kind, id) for id in tables[kind] if id not in counts)
+
+        removed = dict.fromkeys(kinds, 0)
+        deferred = set()
+        while references.pending:
+            kind, id = references.pending.pop()
+            if kind not in removed:
+                deferred.add((kind, id))
+            elif id in tables[kind] and references.count(kind, id) == 0:
+                if kind == 'node':
+                    del self.nodes[id]
+                elif kind == 'way':
+                    self.delete_way(id)
+                else:
+                    self.delete_relation(id)
+                removed[kind] += 1
+        references.pending = deferred
+
+        if removed.get('node'):
+            self.nodes_changed()
+        return removed
+
+    # Function: load
+    #
+    # Parses osm_file. With cache, <osm_file>.cache.npz is read instead when it was written for the same file: same
+    # size and mtime, or failing the mtime, the same contents. A missing, stale or unreadable cache is rebuilt
+    # after parsing
+    #
+    def load(self, osm_file, cache=False):
+        self.osm_file = osm_file
+        if cache:
+            cache_file = osm_file + '.cache.npz'
+            size, mtime = document_cache_key(osm_file)
+            try:
+                if self.load_cache(cache_file, size, mtime, osm_file):
+                    return
+            except CACHE_READ_ERRORS:
+                # from_arrays may have got part of the way through
+                self.clear()
+        record_file_read(osm_file, full_scan=True)
+        with open(osm_file) as f:
+            self.parse(f)
+        if cache:
+            try:
+                self.save_cache(cache_file, size, mtime, map_fingerprint(osm_file))
+            except OSError:
+                pass
+
+    # Function: to_arrays
+    #
+    # The document as columnar arrays: every line in one utf-8 string with character offsets, element id and line
+    # count arrays, way refs as a ragged array and relation members as type, ref and role columns. from_arrays
+    # rebuilds it by slicing lines, none of them are parsed again
+    #
+    def to_arrays(self):
+        lines = list(self.header)
+        node_counts = []
+        for node in self.nodes.values():
+            lines.extend(node.lines)
+            node_counts.append(len(node.lines))
+        way_counts = []
+        for way in self.ways.values():
+            lines.extend(way.metadata)
+            lines.extend(way.data)
+            lines.extend(way.end)
+            way_counts.append((len(way.metadata), len(way.data), len(way.end)))
+        relation_counts, is_member, members = [], [], []
+        for relation in self.relations.values():
+            lines.append(relation.header)
+            for item in relation.body:
+                if isinstance(item, str):
+                    lines.append(item)
+                    is_member.append(False)
+                else:
+                    lines.append(item.line)
+                    is_member.append(True)
+                    members.append(item)
+            lines.extend(relation.end)
+            relation_counts.append((len(relation.body), len(relation.end)))
+        lines.extend(self.footer)
+        leading_kinds, leading_ids, leading_counts = [], [], []
+        for (kind, id), leading in self.leading.items():
+            lines.extend(leading)
+            leading_kinds.append(kind)
+            leading_ids.append(id)
+            leading_counts.append(len(leading))
+
+        line_offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(line) for line in lines), dtype=np.int64, count=len(lines)), out=line_offsets[1:])
+        return dict(
+            text=np.frombuffer(''.join(lines).encode('utf-8'), dtype=np.uint8), line_offsets=line_offsets,
+            header_count=np.int64(len(self.header)), footer_count=np.int64(len(self.footer)),
+            node_ids=np.fromiter(self.nodes.keys(), dtype=np.int64, count=len(self.nodes)),
+            node_lats=np.fromiter((node.lat for node in self.nodes.values()), dtype=np.float64, count=len(self.nodes)),
+            node_lons=np.fromiter((node.lon for node in self.nodes.values()), dtype=np.float64, count=len(self.nodes)),
+            node_counts=np.array(node_counts, dtype=np.int64),
+            way_ids=np.fromiter(self.ways.keys(), dtype=np.int64, count=len(self.ways)),
+            way_index=np.array([-1 if way.index is None else way.index for way in self.ways.values()],
+                               dtype=np.int64),
+            way_counts=np.array(way_counts, dtype=np.int64).reshape(-1, 3),
+            way_refs=np.fromiter(itertools.chain.from_iterable(way.refs for way in self.ways.values()),
+                                 dtype=np.int64),
+            relation_ids=np.fromiter(self.relations.keys(), dtype=np.int64, count=len(self.relations)),
+            relation_counts=np.array(relation_counts, dtype=np.int64).reshape(-1, 2),
+            is_member=np.array(is_member, dtype=bool),
+            member_types=np.array([member.type for member in members], dtype=str),
+            member_refs=np.array([member.ref for member in members], dtype=np.int64),
+            member_roles=np.array([member.role for member in members], dtype=str),
+            leading_kinds=np.array(leading_kinds, dtype=str), leading_ids=np.array(leading_ids, dtype=np.int64),
+            leading_counts=np.array(leading_counts, dtype=np.int64),
+            largest_id=np.int64(self.ids.largest))
+
+    # Function: from_arrays
+    #
+    # Adds the elements of to_arrays output to this document, after anything already in it. line_offset is added to
+    # the way line indices, for arrays made from a chunk in the middle of a file. Footer lines already in the
+    # document came between the two parts, so they become leading lines of the first element added. The header,
+    # footer and way_users are filled in straight away, the element objects only when a table is first used
+    #
+    def from_arrays(self, arrays, line_offset=0):
+        part = DocumentPart(arrays, line_offset)
+        self.header.extend(part.lines(0, part.node_start))
+        between = self.footer
+        first_kind = next((kind for kind in ('node', 'way', 'relation') if len(part.ids[kind])), None)
+        if between and first_kind is not None:
+            key = (first_kind, int(part.ids[first_kind][0]))
+            self.footer = []
+            self.leading[key] = between + self.leading.get(key, [])
+
+        self.footer.extend(part.lines(part.footer_start, part.leading_start))
+        position = part.leading_start
+        for kind, id, count in zip(arrays['leading_kinds'].tolist(), arrays['leading_ids'].tolist(),
+                                   arrays['leading_counts'].tolist()):
+            self.leading[(kind, id)] = self.leading.get((kind, id), []) + part.lines(position, position + count)
+            position += count
+
+        # way_users comes from the member columns, so the relations themselves can wait
+        relation_of_line = np.repeat(part.ids['relation'], part.relation_counts[:, 0])
+        relation_of_member = relation_of_line[part.is_member].tolist()
+        for relation_id, type, ref, role in zip(relation_of_member, part.member_types, part.member_refs,
+                                                part.member_roles):
+            if type == 'way':
+                self.way_users.setdefault(ref, []).append((relation_id, role))
+
+        for kind in ('node', 'way', 'relation'):
+            if len(part.ids[kind]):
+                self._pending[kind].append(part)
+        self.ids.observe(int(arrays['largest_id']))
+        self.nodes_changed()
+
+    # Builds the element objects of one kind from the parts from_arrays left pending, in order
+    def _materialize(self, kind):
+        parts, self._pending[kind] = self._pending[kind], []
+        table = {'node': self._nodes, 'way': self._ways, 'relation': self._relations}[kind]
+        for part in parts:
+            table.update(getattr(part, kind + 's')())
+
+    def save_cache(self, cache_file, size, mtime, fingerprint):
+        write_npz_atomic(cache_file, size=np.int64(size), mtime=np.int64(mtime), fingerprint=np.array(fingerprint),
+                         **self.to_arrays())
+
+    # Loads a cache written by save_cache, returning False without changing anything if it was written for a
+    # different version of osm_file. A cache whose contents still match after a touch or checkout is rewritten with
+    # the new mtime, so the next load doesn't hash the map again
+    def load_cache(self, cache_file, size, mtime, osm_file):
+        if not os.path.exists(cache_file):
+            return False
+        record_file_read(cache_file)
+        with np.load(cache_file) as arrays:
+            if int(arrays['size']) != size:
+                return False
+            stale_mtime = int(arrays['mtime']) != mtime
+            if stale_mtime and str(arrays['fingerprint']) != map_fingerprint(osm_file):
+                return False
+            # Caches written before the lines between elements were kept can't round-trip the file
+            if 'leading_kinds' not in arrays:
+                return False
+            self.from_arrays(arrays)
+            if stale_mtime:
+                refreshed = {name: arrays[name] for name in arrays.files}
+        if stale_mtime:
+            refreshed['mtime'] = np.int64(mtime)
+            try:
+                write_npz_atomic(cache_file, **refreshed)
+            except OSError:
+                pass
+        return True
+
+    # Attributes are read with get_attribute, so their order and quote style don't matter
+    def parse(self, lines):
+        find_id = ATTRIBUTES['id'].search
+        find_lat = ATTRIBUTES['lat'].search
+        find_lon = ATTRIBUTES['lon'].search
+        find_ref = ATTRIBUTES['ref'].search
+
+        element = None
+        seen_element = False
+        # Lines between elements, until the element they come before is known
+        pending = []
+        for i, line in enumerate(lines):
+            line_stripped = line.strip()
+            if isinstance(element, OsmNode):
+                element.lines.append(line)
+                if line_stripped[0:len("</node>")] == "</node>":
+                    element = None
+            elif isinstance(element, OsmWay):
+                if line_stripped.startswith(ND_START):
+                    element.data.append(line)
+                    element.refs.append(int(find_ref(line).group(3)))
+                elif line_stripped[0:len("</way>")] == "</way>":
+                    element.end.append(line)
+                    element.index = i
+                    element = None
+                elif element.data:
+                    element.end.append(line)
+                else:
+                    element.metadata.append(line)
+            elif isinstance(element, OsmRelation):
+                if line_stripped.startswith(MEMBER_START):
+                    member = OsmMember(line)
+                    element.body.append(member)
+                    if member.type == 'way':
+                        self.way_users.setdefault(member.ref, []).append((element.id, member.role))
+                elif line_stripped[0:len("</relation>")] == "</relation>":
+                    element.end.append(line)
+                    element = None
+                else:
+                    element.body.append(line)
+            elif line_stripped.startswith(NODE_START):
+                seen_element = True
+                id = int(find_id(line).group(3))
+                node = OsmNode(id, float(find_lat(line).group(3)), float(find_lon(line).group(3)), [line])
+                self.nodes[id] = node
+                if pending:
+                    self.leading[('node', id)], pending = pending, []
+                if line_stripped[-2:] != "/>":
+                    element = node
+            elif line_stripped.startswith(WAY_START):
+                seen_element = True
+                way = OsmWay(int(find_id(line).group(3)), [line], index=i)
+                self.ways[way.id] = way
+                if pending:
+                    self.leading[('way', way.id)], pending = pending, []
+                if line_stripped[-2:] != "/>":
+                    element = way
+            elif line_stripped.startswith(RELATION_START):
+                seen_element = True
+                relation = OsmRelation(int(find_id(line).group(3)), line)
+                self.relations[relation.id] = relation
+                if pending:
+                    self.leading[('relation', relation.id)], pending = pending, []
+                if line_stripped[-2:] != "/>":
+                    element = relation
+            elif seen_element:
+                pending.append(line)
+            else:
+                self.header.append(line)
+        self.footer.extend(pending)
+        self.ids = IdAllocator(self._scan_largest_id())
+        self.nodes_changed()
+
+    # The document as text. keep, a {kind: ids} dict like get_lanelet_closure returns, limits it to those elements
+    def lines(self, keep=None):
+        leading = self.leading
+        yield from self.header
+        for id, node in self.nodes.items():
+            if keep is None or id in keep['node']:
+                yield from leading.get(('node', id), ())
+                yield from node.lines
+        for id, way in self.ways.items():
+            if keep is None or id in keep['way']:
+                yield from leading.get(('way', id), ())
+                yield from way.metadata
+                yield from way.data
+                yield from way.end
+        for id, relation in self.relations.items():
+            if keep is None or id in keep['relation']:
+                yield from leading.get(('relation', id), ())
+                yield from relation.lines(keep)
+        yield from self.footer
+
+    def save(self, osm_file=None, keep=None):
+        if osm_file is None:
+            osm_file = self.osm_file
+        write_lines_atomic(osm_file, self.lines(keep))
+
+    def get_way_data(self, id):
+        way = self.ways.get(int(id))
+        if way is None:
+            return None, None, None, None
+        return list(way.metadata), list(way.data), list(way.end), way.index
+
+    def make_way_dashed(self, way_id):
+        way = self.ways.get(int(way_id))
+        if way is None:
+            print(f'problems finding way {way_id}')
+            return
+        way.set_tag('subtype', 'dashed')
+
+    def make_ways_dashed(self, way_list):
+        for way_id in way_list:
+            self.make_way_dashed(way_id)
+
+    def get_lat_lon_from_point(self, id):
+        node = self.nodes.get(int(id))
+        if node is None:
+            return None, None
+        return node.lat, node.lon
+
+    # Points the first member of the lanelet that uses current_boundary at updated_boundary instead
+    # Returns the updated member line, or None if the lanelet doesn't use current_boundary
+    def change_lanelet_boundary(self, lanelet, current_boundary, updated_boundary):
+        relation = self.relations.get(int(lanelet))
+        if relation is None:
+            return None
+        for member in relation.way_members():
+            if member.ref == int(current_boundary):
+                self.set_member_ref(relation, member, updated_boundary)
+                return member.line
+        return None
+
+    def get_lat_lon_from_data_line(self, line):
+        return self.get_lat_lon_from_point(get_attribute(line, 'ref'))
+
+    def compute_lanelet_boundary_angle(self, data_lines):
+        middle = (len(data_lines) - 1) // 2
+        x, y = self.get_node_xy([int(get_attribute(line, 'ref')) for line in data_lines[middle:middle + 2]])
+        angle = np.arctan2(y[1] - y[0], x[1] - x[0])
+        return angle
+
+    # Given a doubled lanelet boundary, get the lanelets associated with it and the other boundary of each,
+    # as [doubled boundary, lanelet 1, other boundary 1, lanelet 2, other boundary 2]
+    def get_boundaries_lanelets_from_doubled_boundary(self, doubled_boundary):
+        doubled_data = [int(doubled_boundary)]
+        for relation_id, role in self.get_way_users(doubled_boundary):
+            boundaries = self.relations[relation_id].boundaries()
+            if role in ('left', 'right') and boundaries is not None:
+                doubled_data.append(relation_id)
+                doubled_data.append(boundaries[1] if role == 'left' else boundaries[0])
+            if len(doubled_data) >= 5:
+                return doubled_data
+        return None
+
+    # Function: get_doubled_centerlines
+    #
+    # Finds every way that more than one lanelet uses with the same role, e.g. as the left boundary of both.
+    # This is a query over way_users, so it doesn't depend on the layout of the relations in the file
+    #
+    # Returns:
+    #
+    #    A list of DoubledBoundary, one per doubled way, listing every lanelet that uses the way
+    #
+    def get_doubled_centerlines(self):
+        # Lanelets missing a boundary are skipped, as in get_lanelet_boundaries
+        lanelet_ids = {relation_id for relation_id in self.get_all_lanelets()
+                       if self.relations[relation_id].boundaries() is not None}
+        boundary_users = {way_id: [(relation_id, role) for relation_id, role in users
+                                   if relation_id in lanelet_ids and role in ('left', 'right')]
+                          for way_id, users in self.way_users.items()}
+        counts = np.fromiter((len(users) for users in boundary_users.values()), dtype=np.int64,
+                             count=len(boundary_users))
+        way_ids = np.repeat(np.fromiter(boundary_users.keys(), dtype=np.int64, count=len(boundary_users)), counts)
+        is_right = np.fromiter((role == 'right' for users in boundary_users.values() for _, role in users),
+                               dtype=bool, count=int(counts.sum()))
+
+        keys, key_counts = np.unique(way_ids * 2 + is_right, return_counts=True)
+        doubled_ways = np.unique(keys[key_counts > 1] // 2)
+
+        records = []
+        for way_id in doubled_ways.tolist():
+            users = boundary_users[way_id]
+            other_boundaries = []
+            for relation_id, role in users:
+                left, right = self.relations[relation_id].boundaries()
+                other_boundaries.append(right if role == 'left' else left)
+            records.append(DoubledBoundary(way_id, [relation_id for relation_id, _ in users],
+                                           [role for _, role in users], other_boundaries))
+        return records
+
+    # Function: choose_lanelets_to_flip
+    #
+    # Decides, for every doubled boundary at once, which lanelets have it backwards. Of the lanelets repeating a
+    # role, the one whose other boundary is best aligned with the doubled way keeps it and every other one is flipped,
+    # so a way used as left by three lanelets gets two flips. On a tie the later lanelet keeps the way
+    #
+    # Returns:
+    #
+    #    [(lanelet, doubled way), ...] in the order of doubled_boundaries
+    #
+    def choose_lanelets_to_flip(self, doubled_boundaries):
+        records = [record if isinstance(record, DoubledBoundary) else DoubledBoundary.from_list(record)
+                   for record in doubled_boundaries]
+        groups, lanelets, doubled_ways, other_ways = [], [], [], []
+        for i, record in enumerate(records):
+            for lanelet, role, other in zip(record.lanelets, record.roles, record.other_boundaries):
+                # Only the lanelets repeating a role are candidates, the others use the way legitimately
+                if record.roles.count(role) > 1:
+                    groups.append((i, role == 'right'))
+                    lanelets.append(lanelet)
+                    doubled_ways.append(record.way)
+                    other_ways.append(other)
+        if not groups:
+            return []
+
+        way_ids = np.unique(np.asarray(doubled_ways + other_ways, dtype=np.int64))
+        way_table = WayTable.from_ways(self.ways, way_ids)
+        headings = compute_way_headings(self.node_store, way_table, self.get_local_xy())
+        diffs = angle_difference(headings[way_table.rows(other_ways)], headings[way_table.rows(doubled_ways)])
+        diffs = np.nan_to_num(diffs, nan=-1.0)
+
+        # Smallest diff of each (record, role) group first, then the later lanelet on a tie. That one is kept
+        group_keys = np.array([i * 2 + is_right for i, is_right in groups], dtype=np.int64)
+        order = np.lexsort((-np.arange(len(groups)), diffs, group_keys))
+        flipped = np.ones(len(groups), dtype=bool)
+        _, first = np.unique(group_keys[order], return_index=True)
+        flipped[order[first]] = False
+        return [(lanelets[i], doubled_ways[i]) for i in np.nonzero(flipped)[0].tolist()]
+
+    # See fix_doubled_centerlines
+    def fix_doubled_centerlines(self, doubled_boundaries):
+        flips = self.choose_lanelets_to_flip(doubled_boundaries)
+        # Lanelets flipped off the same way with the same role each need their own copy, or the copy is doubled.
+        # A left and a right flip can share one
+        reversed_copies = {}
+        copies_used = collections.Counter()
+        reversed_ways = {}
+        for lanelet_to_update, doubled_boundary in flips:
+            print(lanelet_to_update)
+            role = next(member.role for member in self.relations[lanelet_to_update].way_members()
+                        if member.ref == doubled_boundary)
+            key = (doubled_boundary, copies_used[(doubled_boundary, role)])
+            copies_used[(doubled_boundary, role)] += 1
+            if key not in reversed_copies:
+                edited_way = self.ways[doubled_boundary].copy(self.ids.allocate())
+                edited_way.reverse()
+                self.add_way(edited_way)
+                reversed_copies[key] = edited_way.id
+            edited_boundary_id = reversed_copies[key]
+            self.change_lanelet_boundary(lanelet_to_update, doubled_boundary, edited_boundary_id)
+            reversed_ways[lanelet_to_update] = edited_boundary_id
+
+        print('done')
+        return reversed_ways
+
+    # Reverses the way in place, or with create_new gives the lanelet a reversed copy and leaves the original alone
+    def reverse_way(self, lanelet_id, way_id, create_new=False):
+        way = self.ways[int(way_id)]
+        if create_new:
+            edited_boundary_id = self.ids.allocate()
+            edited_way = way.copy(edited_boundary_id)
+            edited_way.reverse()
+            self.add_way(edited_way)
+            self.change_lanelet_boundary(lanelet_id, way_id, edited_boundary_id)
+        else:
+            way.reverse()
+
+    def reverse_lanelets(self, lanelet_list):
+        if lanelet_list == 'all':
+            lanelet_list = self.get_all_lanelets()
+
+        ways = {}
+        for lanelet_id in lanelet_list:
+            way1, way2 = self.get_ways_from_lanelet(lanelet_id)
+            ways[str(way1)] = lanelet_id
+            ways[str(way2)] = lanelet_id
+
+        for way in ways.keys():
+            try:
+                self.reverse_way(ways[way], int(way))
+            except:
+                print(f'got bad lanelet, I think: {way} - {ways[way]}')
+
+    def get_ways_from_lanelet(self, lanelet_id):
+        relation = self.relations.get(int(lanelet_id))
+        if relation is not None:
+            boundaries = relation.boundaries()
+            if boundaries is not None:
+                return boundaries
+
+        print(f'problems finding lanelet {lanelet_id}')
+        return None, None
+
+    # Arrays of lanelet ids and their left and right boundaries, skipping lanelets without two boundaries
+    def get_lanelet_boundaries(self, lanelets=None):
+        if lanelets is None:
+            lanelets = self.get_all_lanelets()
+        lanelet_ids, left, right = [], [], []
+        for lanelet in lanelets:
+            relation = self.relations.get(int(lanelet))
+            boundaries = None if relation is None else relation.boundaries()
+            if boundaries is not None:
+                lanelet_ids.append(relation.id)
+                left.append(boundaries[0])
+                right.append(boundaries[1])
+        return (np.array(lanelet_ids, dtype=np.int64), np.array(left, dtype=np.int64),
+                np.array(right, dtype=np.int64))
+
+    def grab_start_and_end_points_from_way(self, way_id):
+        way = self.ways[int(way_id)]
+        return way.refs[0], way.refs[-1]
+
+    def globally_replace_point(self, replacer, replacee):
+        self.apply_point_remap({int(replacee): int(replacer)})
+
+    # Function: apply_point_remap
+    #
+    # Points every reference to a node in remap at remap[node] instead, and deletes the remapped nodes.
+    # Everything happens in one pass over the ways and relations, however many nodes are remapped
+    #
+    # With collapse_repeats, a way that ends up with the same node twice in a row keeps only one of them
+    #
+    # Returns:
+    #
+    #    The number of references that were updated
+    #
+    def apply_point_remap(self, remap, collapse_repeats=False):
+        if not remap:
+            return 0
+        for replacee in remap:
+            self.nodes.pop(replacee, None)
+        self.nodes_changed()
+
+        updated = 0
+        for way in self.ways.values():
+            if remap.keys().isdisjoint(way.refs):
+                continue
+            refs = list(way.refs)
+            data = list(way.data)
+            for i, ref in enumerate(refs):
+                if ref in remap:
+                    refs[i] = remap[ref]
+                    data[i] = set_attribute(data[i], 'ref', str(remap[ref]))
+                    updated += 1
+            if collapse_repeats:
+                keep = [i for i in range(len(refs)) if i == 0 or refs[i] != refs[i - 1]]
+                refs = [refs[i] for i in keep]
+                data = [data[i] for i in keep]
+            self.set_way_refs(way, refs, data)
+        for relation in self.relations.values():
+            for member in relation.members:
+                if member.type == 'node' and member.ref in remap:
+                    self.set_member_ref(relation, member, remap[member.ref])
+                    updated += 1
+        return updated
+
+    # Function: deduplicate_points
+    #
+    # Merges nodes with exactly the same lat/lon into the first one seen, in two linear passes: one to build the
+    # remap table, and one to apply it
+    #
+    # Returns:
+    #
+    #    A dict with the number of nodes scanned, duplicates removed, references updated, and the remap table
+    #    {duplicate id: kept id}
+    #
+    def deduplicate_points(self):
+        seen = {}
+        remap = {}
+        for id, node in self.nodes.items():
+            canonical = seen.setdefault((node.lat, node.lon), id)
+            if canonical != id:
+                remap[id] = canonical
+        nodes_scanned = len(self.nodes)
+
+        updated = self.apply_point_remap(remap)
+        return {'nodes_scanned': nodes_scanned, 'duplicates': len(remap), 'references_updated': updated,
+                'remap': remap}
+
+    # Function: merge_nearby_points
+    #
+    # Merges every cluster of nodes within tolerance m of each other into the lowest id of the cluster, then
+    # rewrites all references in one pass. Ways are left without the same node twice in a row
+    #
+    # Returns:
+    #
+    #    A dict with the number of nodes scanned, clusters found, nodes merged, references updated, and the remap
+    #    table {merged id: kept id}
+    #
+    def merge_nearby_points(self, tolerance=0.05):
+        store = self.node_store
+        x, y = self.get_local_xy()
+        roots = find_point_clusters(x, y, tolerance)
+        merged = np.nonzero(roots != np.arange(len(roots)))[0]
+        remap = dict(zip(store.ids[merged].tolist(), store.ids[roots[merged]].tolist()))
+        nodes_scanned = len(store)
+
+        updated = self.apply_point_remap(remap, collapse_repeats=True)
+        return {'nodes_scanned': nodes_scanned, 'clusters': len(np.unique(roots[merged])), 'merged': len(remap),
+                'references_updated': updated, 'remap': remap}
+
+    # Returns the number of nodes removed, see collect_garbage
+    def remove_orphaned_points(self):
+        return self.collect_garbage(('node',), full=True)['node']
+
+    # Function: get_lanelet_closure
+    #
+    # Everything a set of lanelets needs to stand on its own: the lanelets, the regulatory elements they use or that
+    # refer to them, every way those relations use, and every node of those ways. Other lanelets reached through a
+    # regulatory element are not pulled in
+    #
+    # Returns:
+    #
+    #    A dict {'node': ids, 'way': ids, 'relation': ids} of sets
+    #
+    def get_lanelet_closure(self, lanelet_ids):
+        lanelets = set(int(lanelet) for lanelet in lanelet_ids if int(lanelet) in self.relations)
+        relations = set(lanelets)
+        for lanelet in lanelets:
+            relations.update(member.ref for member in self.relations[lanelet].members
+                             if member.type == 'relation' and member.ref in self.relations)
+        for relation in self.relations.values():
+            if relation.is_regulatory_element() and \
+                    any(member.type == 'relation' and member.ref in lanelets for member in relation.members):
+                relations.add(relation.id)
+
+        ways = set()
+        nodes = set()
+        for relation_id in relations:
+            for member in self.relations[relation_id].members:
+                if member.type == 'way' and member.ref in self.ways:
+                    ways.add(member.ref)
+                elif member.type == 'node' and member.ref in self.nodes:
+                    nodes.add(member.ref)
+        for way in ways:
+            nodes.update(self.ways[way].refs)
+        return {'node': nodes, 'way': ways, 'relation': relations}
+
+    # Drops everything outside get_lanelet_closure(lanelets_to_keep) in one pass over each table
+    def remove_lanelets_except(self, lanelets_to_keep):
+        keep = self.get_lanelet_closure(lanelets_to_keep)
+        self.nodes = {id: node for id, node in self.nodes.items() if id in keep['node']}
+        self.ways = {id: way for id, way in self.ways.items() if id in keep['way']}
+        self.relations = {id: relation for id, relation in self.relations.items() if id in keep['relation']}
+        for relation in self.relations.values():
+            relation.body = [item for item in relation.body
+                             if isinstance(item, str) or item.ref in keep.get(item.type, ())]
+        self.rebuild_way_users()
+        self._references = None
+        self.nodes_changed()
+
+    # remove the lanelet definition and the two boundary ways, then clean up the points only they used.
+    # Boundaries that another relation still uses are kept. Reference counts make this independent of map size
+    def remove_lanelet(self, lanelet_id, remove_orphans=True):
+        references = self.enable_reference_counting()
+        relation = self.delete_relation(int(lanelet_id))
+        if relation is None:
+            print(f'problems finding lanelet {lanelet_id}')
+            return
+
+        for member in relation.way_members():
+            if member.role in ('left', 'right') and references.count('way', member.ref) == 0:
+                self.delete_way(member.ref)
+
+        if remove_orphans:
+            self.collect_garbage(('node',))
+
+    def remove_points(self, points):
+        points = set(int(point) for point in points)
+        for point in points:
+            if self.nodes.pop(point, None) is not None:
+                print(f'removed {point}')
+        self.nodes_changed()
+
+        for way in self.ways.values():
+            if not points.isdisjoint(way.refs):
+                keep = [i for i, ref in enumerate(way.refs) if ref not in points]
+                self.set_way_refs(way, [way.refs[i] for i in keep], [way.data[i] for i in keep])
+
+    def remove_point(self, point_id):
+        self.remove_points([point_id])
+
+    def globally_replace_way(self, replacer, replacee):
+        self.apply_way_remap({int(replacee): int(replacer)})
+
+    # Function: apply_way_remap
+    #
+    # Points every relation member referencing a way in remap at remap[way] instead, and deletes the remapped ways.
+    # Only the relations way_users lists for each remapped way are touched
+    #
+    # Returns:
+    #
+    #    The number of members that were updated
+    #
+    def apply_way_remap(self, remap):
+        if not remap:
+            return 0
+        updated = 0
+        for replacee, replacer in remap.items():
+            for relation_id in set(relation_id for relation_id, _ in self.get_way_users(replacee)):
+                relation = self.relations[relation_id]
+                for member in relation.way_members():
+                    if member.ref == replacee:
+                        self.set_member_ref(relation, member, replacer)
+                        updated += 1
+            self.delete_way(replacee)
+        return updated
+
+    # Function: deduplicate_ways
+    #
+    # Merges ways with the same node sequence into the first one seen, in one pass over the ways and one over the
+    # relations
+    #
+    # Parameters:
+    #
+    #    endpoints_only - treat ways as duplicates when only their first and last nodes match
+    #    merge_reversed - also merge ways that are duplicates when reversed. This flips the direction of the way for
+    #                     the relations that used the duplicate, so by default they are only reported
+    #
+    # Returns:
+    #
+    #    A dict with the number of ways scanned, duplicates removed, references updated, the remap table
+    #    {duplicate id: kept id}, and the reversed duplicates {way id: way it reverses}
+    #
+    def deduplicate_ways(self, endpoints_only=False, merge_reversed=False):
+        seen = {}
+        remap = {}
+        reversed_duplicates = {}
+        for way_id, way in self.ways.items():
+            if not way.refs:
+                continue
+            key = (way.refs[0], way.refs[-1]) if endpoints_only else tuple(way.refs)
+            if key in seen:
+                remap[way_id] = seen[key]
+            elif key[::-1] in seen:
+                reversed_duplicates[way_id] = seen[key[::-1]]
+                if merge_reversed:
+                    remap[way_id] = seen[key[::-1]]
+            else:
+                seen[key] = way_id
+        ways_scanned = len(self.ways)
+
+        updated = self.apply_way_remap(remap)
+        return {'ways_scanned': ways_scanned, 'duplicates': len(remap), 'references_updated': updated,
+                'remap': remap, 'reversed_duplicates': reversed_duplicates}
+
+    def get_all_lanelets(self):
+        return [relation.id for relation in self.relations.values() if relation.is_lanelet()]
+
+    def get_lanelet_graph(self, lane_change_subtypes=('dashed',)):
+        return LaneletGraph.from_document(self, lane_change_subtypes)
+
+    # RoutingGraph of the map, weighted by the lanelet lengths compute_lanelet_length estimates
+    def get_routing_graph(self, lane_change_cost=0.0, fingerprint=''):
+        table = self.compute_lanelet_lengths()
+        lengths = dict(zip(table.lanelet_ids.tolist(), table.lengths.tolist()))
+        return RoutingGraph.from_lanelet_graph(self.get_lanelet_graph(), lengths, lane_change_cost, fingerprint)
+
+    # lat_0 and lon_0 of the <geoReference>, or None, None if the map doesn't have one
+    def get_georeference_origin(self):
+        for line in self.header:
+            if (line.strip())[0:len('<geoReference>')] == '<geoReference>':
+                lat_0 = GEO_LAT_0.search(line)
+                lon_0 = GEO_LON_0.search(line)
+                if lat_0 is not None and lon_0 is not None:
+                    return float(lat_0.group(2)), float(lon_0.group(2))
+        return None, None
+
+    # The geoReference origin, or the middle of the map if it doesn't have one
+    def get_origin(self):
+        lat_0, lon_0 = self.get_georeference_origin()
+        if lat_0 is None:
+            store = self.node_store
+            lat_0, lon_0 = float(np.mean(store.lats)), float(np.mean(store.lons))
+        return lat_0, lon_0
+
+    # TransverseMercator of the <geoReference>, parsed once. A map without one is projected around its middle
+    def get_projection(self):
+        if self._projection is None:
+            for line in self.header:
+                if (line.strip())[0:len('<geoReference>')] == '<geoReference>':
+                    self._projection = TransverseMercator.from_georeference(line)
+                    break
+            if self._projection is None:
+                self._projection = TransverseMercator(*self.get_origin())
+        return self._projection
+
+    # Projected x/y in m of every node, in node_store order. Cached until nodes_changed
+    def get_local_xy(self):
+        if self._local_xy is None:
+            store = self.node_store
+            self._local_xy = self.get_projection().project(store.lats, store.lons)
+        return self._local_xy
+
+    # Projected x and y arrays of the given node ids
+    def get_node_xy(self, ids):
+        rows = self.node_store.rows(ids)
+        x, y = self.get_local_xy()
+        return x[rows], y[rows]
+
+    # GridIndex of every node at its projected position. Cached until nodes_changed
+    def get_node_index(self):
+        if self._node_index is None:
+            x, y = self.get_local_xy()
+            self._node_index = GridIndex(self.node_store.ids, x, y, x, y)
+        return self._node_index
+
+    # GridIndex of the projected bounding boxes of the lanelets, covering both boundaries. Built on every call, as
+    # lanelets can be edited without touching the nodes
+    def get_lanelet_index(self, lanelets=None, cell_size=None):
+        lanelet_ids, left, right = self.get_lanelet_boundaries(lanelets)
+        if len(lanelet_ids) == 0:
+            return GridIndex(lanelet_ids, [], [], [], [], cell_size)
+        way_table = WayTable.from_ways(self.ways, np.unique(np.concatenate([left, right])))
+        x, y = self.get_node_xy(way_table.refs)
+        # Boundaries without nodes have no box, so their lanelets are left out of the index
+        filled = way_table.lengths() > 0
+        bounds = []
+        for function, values in ((np.minimum, x), (np.minimum, y), (np.maximum, x), (np.maximum, y)):
+            bound = np.full(len(way_table), np.nan)
+            bound[filled] = function.reduceat(values, way_table.offsets[:-1][filled]) if len(values) else []
+            bounds.append(bound)
+        left_rows, right_rows = way_table.rows(left), way_table.rows(right)
+        min_x, min_y = (np.minimum(values[left_rows], values[right_rows]) for values in bounds[:2])
+        max_x, max_y = (np.maximum(values[left_rows], values[right_rows]) for values in bounds[2:])
+        keep = ~np.isnan(min_x)
+        return GridIndex(lanelet_ids[keep], min_x[keep], min_y[keep], max_x[keep], max_y[keep], cell_size)
+
+    # Sorted ids of the nodes inside a box of projected coordinates, see get_local_xy
+    def find_nodes_in_box(self, min_x, min_y, max_x, max_y):
+        return self.get_node_index().query_box(min_x, min_y, max_x, max_y)
+
+    # Sorted ids of the nodes within radius m of the projected point (x, y)
+    def find_nodes_near(self, x, y, radius):
+        return self.get_node_index().query_radius(x, y, radius)
+
+    # Sorted ids of the lanelets whose bounding box intersects a box of projected coordinates
+    def find_lanelets_in_box(self, min_x, min_y, max_x, max_y, lanelet_index=None):
+        if lanelet_index is None:
+            lanelet_index = self.get_lanelet_index()
+        return lanelet_index.query_box(min_x, min_y, max_x, max_y)
+
+    # Function: find_lanelets_near
+    #
+    # Finds the lanelets within radius m of a projected point. The lanelet index narrows the search to lanelets
+    # whose bounding box is close enough, then the distance to the lanelet polygon (left boundary, then the right one
+    # reversed) decides, so a point inside a lanelet is at distance 0
+    #
+    # Parameters:
+    #
+    #    x, y - the point, see get_local_xy
+    #    radius - search distance in m
+    #    lanelet_index - GridIndex from get_lanelet_index, to reuse it over many queries
+    #
+    # Returns:
+    #
+    #    (lanelet ids, distances in m), sorted by distance
+    #
+    def find_lanelets_near(self, x, y, radius, lanelet_index=None):
+        if lanelet_index is None:
+            lanelet_index = self.get_lanelet_index()
+        rows, _ = lanelet_index.radius_rows(x, y, radius)
+        lanelet_ids = lanelet_index.ids[rows]
+        if len(lanelet_ids) == 0:
+            return lanelet_ids, np.zeros(0)
+
+        rings = []
+        for lanelet in lanelet_ids.tolist():
+            left, right = self.relations[lanelet].boundaries()
+            rings.append(np.concatenate([self.ways[left].refs, self.ways[right].refs[::-1]]).astype(np.int64))
+        ring_lengths = np.array([len(ring) for ring in rings])
+        refs = np.concatenate(rings)
+        ring_x, ring_y = self.get_node_xy(refs)
+        # Each node connects to the next one in its ring, the last one back to the first
+        next_rows = np.arange(1, len(refs) + 1)
+        next_rows[np.cumsum(ring_lengths) - 1] = np.cumsum(ring_lengths) - ring_lengths
+        owners = np.repeat(np.arange(len(rings)), ring_lengths)
+        distances = polygon_distances(x, y, ring_x, ring_y, ring_x[next_rows], ring_y[next_rows], owners, len(rings))
+
+        close = distances <= radius
+        order = np.lexsort((lanelet_ids[close], distances[close]))
+        return lanelet_ids[close][order], distances[close][order]
+
+    # Latitudes and longitudes of every node in the way, in order
+    def get_way_coordinates(self, way_id):
+        return self.node_store.lat_lon(self.ways[int(way_id)].refs)
+
+    # Without lat_to_m and lon_to_m the way is measured in the projected plane, see get_local_xy
+    def compute_way_length(self, way, lat_to_m=None, lon_to_m=None):
+        distance = 0
+        too_close = []
+
+        data = self.ways[int(way)].refs
+        if lat_to_m is None:
+            xs, ys = self.get_node_xy(data)
+        else:
+            lats, lons = self.get_way_coordinates(way)
+            xs, ys = lon_to_m * lons, lat_to_m * lats
+        distances = np.zeros(len(data))
+
+        last_x, last_y = xs[0], ys[0]
+        for i in range(len(data) // 2):
+            x, y = xs[i], ys[i]
+            dist_step = np.sqrt((x - last_x)**2 + (y - last_y)**2)
+
+            if i > 0:
+                if dist_step < 2.0:
+                    too_close.append(data[i])
+                else:
+                    distance += dist_step
+                    distances[i] = dist_step
+                    last_x, last_y = x, y
+
+        last_x, last_y = xs[-1], ys[-1]
+        # Stops at the first node, a one node way would otherwise wrap around and compare it with itself
+        for i in range(len(data) - 1, max(len(data) // 2 - 2, -1), -1):
+            x, y = xs[i], ys[i]
+            dist_step = np.sqrt((x - last_x) ** 2 + (y - last_y) ** 2)
+
+            if i < len(data) - 1:
+                if dist_step < 2.0:
+                    too_close.append(data[i])
+                else:
+                    distance += dist_step
+                    distances[i] = dist_step
+                    last_x, last_y = x, y
+
+        return distance, distances, too_close
+
+    # The largest id in use or handed out by ids, without rescanning the map
+    def get_largest_id(self):
+        return self.ids.largest
+
+    def _scan_largest_id(self):
+        largest = 0
+        for elements in (self.nodes, self.ways, self.relations):
+            if elements:
+                largest = max(largest, max(elements))
+        for relation in self.relations.values():
+            for member in relation.members:
+                if member.type == 'relation' and member.ref > largest:
+                    largest = member.ref
+        return largest
+
+    # Function: plan_lanelet_splits
+    #
+    # Decides where to cut every lanelet compute_lanelet_lengths says is too long, without editing anything. Each
+    # lanelet is cut into splits + 1 pieces of even length, at the same fractions along both boundaries
+    #
+    # Returns:
+    #
+    #    {lanelet: (left way, right way, left cut indices, right cut indices)}. A cut is only kept if it lands
+    #    strictly inside both boundaries and after the previous cut on each. A boundary without an inner node
+    #    ends the lanelet's cuts, so the left and right pieces still pair up
+    #
+    def plan_lanelet_splits(self, lat_to_m=None, lon_to_m=None, lanelets=None, split_dist=150.0, table=None):
+        if table is None:
+            table = self.compute_lanelet_lengths(lat_to_m, lon_to_m, lanelets, split_dist)
+        flagged = np.nonzero(table.splits > 0)[0]
+        cuts = table.splits[flagged]
+        cut_rows = np.repeat(flagged, cuts)
+        # Position of each cut within its lanelet, 1..splits
+        cut_numbers = np.arange(len(cut_rows)) - np.repeat(np.cumsum(cuts) - cuts, cuts) + 1
+        fractions = cut_numbers / (table.splits[cut_rows] + 1)
+        left_indices = find_split_indices(table.way_lengths, table.left[cut_rows], fractions)
+        right_indices = find_split_indices(table.way_lengths, table.right[cut_rows], fractions)
+
+        plans = {}
+        bounds = np.concatenate([[0], np.cumsum(cuts)])
+        for n, row in enumerate(flagged.tolist()):
+            left_cuts, right_cuts = [], []
+            for left_index, right_index in zip(left_indices[bounds[n]:bounds[n + 1]].tolist(),
+                                               right_indices[bounds[n]:bounds[n + 1]].tolist()):
+                if left_index < 0 or right_index < 0:
+                    break
+                if (not left_cuts or left_index > left_cuts[-1]) and (not right_cuts or right_index > right_cuts[-1]):
+                    left_cuts.append(left_index)
+                    right_cuts.append(right_index)
+            plans[int(table.lanelet_ids[row])] = (int(table.left[row]), int(table.right[row]), left_cuts, right_cuts)
+        return plans
+
+    # Function: split_lanelets
+    #
+    # Splits every lanelet plan_lanelet_splits flags, in memory. The lanelet keeps its id and becomes the first
+    # piece, the rest get new relations copying its tags and regulatory elements. Consecutive pieces share the node
+    # at the cut, so they connect as successors. Boundaries are cut into new ways, neighbours cut at the same nodes
+    # share the pieces, and a boundary nothing uses any more is deleted
+    #
+    # Returns:
+    #
+    #    {lanelet: [lanelet, new lanelet, ...]}
+    #
+    def split_lanelets(self, lat_to_m=None, lon_to_m=None, lanelets=None, split_dist=150.0):
+        plans = self.plan_lanelet_splits(lat_to_m, lon_to_m, lanelets, split_dist)
+        boundary_pieces = {}
+
+        pieces = {}
+        for lanelet, (left, right, left_cuts, right_cuts) in plans.items():
+            if not left_cuts:
+                continue
+            relation = self.relations[lanelet]
+            left_pieces = self._split_boundary(left, left_cuts, boundary_pieces)
+            right_pieces = self._split_boundary(right, right_cuts, boundary_pieces)
+            pieces[lanelet] = [lanelet]
+            for new_id, left_piece, right_piece in zip(self.ids.reserve(len(left_cuts)), left_pieces[1:],
+                                                       right_pieces[1:]):
+                new_relation = relation.copy(new_id)
+                for member in new_relation.way_members():
+                    if member.ref == left:
+                        member.set_ref(left_piece)
+                    elif member.ref == right:
+                        member.set_ref(right_piece)
+                self.add_relation(new_relation)
+                pieces[lanelet].append(new_relation.id)
+            self.change_lanelet_boundary(lanelet, left, left_pieces[0])
+            self.change_lanelet_boundary(lanelet, right, right_pieces[0])
+
+        for way_id, _ in boundary_pieces:
+            if way_id in self.ways and not self.get_way_users(way_id):
+                self.delete_way(way_id)
+        return pieces
+
+    # way1 and way2 are looked up from the lanelet, they're kept for older callers
+    def split_lanelet_by_dist(self, lanelet, way1, way2, split_dist, lat_to_m=None, lon_to_m=None):
+        return self.split_lanelets(lat_to_m, lon_to_m, [lanelet], split_dist)
+
+    # Cuts a boundary at cuts, returning the way ids of the pieces in order. boundary_pieces remembers the pieces
+    # of each (way, cuts) so a neighbour cut the same way reuses them
+    def _split_boundary(self, way_id, cuts, boundary_pieces):
+        key = (way_id, tuple(cuts))
+        if key in boundary_pieces:
+            return boundary_pieces[key]
+        way = self.ways[way_id]
+        bounds = [0] + list(cuts) + [len(way.refs) - 1]
+        piece_ids = []
+        for new_id, start, end in zip(self.ids.reserve(len(bounds) - 1), bounds, bounds[1:]):
+            piece = way.copy(new_id)
+            piece.refs = way.refs[start:end + 1]
+            piece.data = way.data[start:end + 1]
+            self.add_way(piece)
+            piece_ids.append(piece.id)
+        boundary_pieces[key] = piece_ids
+        return piece_ids
+
+    # See compute_lanelet_lengths. Without lat_to_m and lon_to_m the lengths are measured in the projected plane
+    def compute_lanelet_lengths(self, lat_to_m=None, lon_to_m=None, lanelets=None, split_dist=150.0):
+        lanelet_ids, left, right = self.get_lanelet_boundaries(lanelets)
+        way_table = WayTable.from_ways(self.ways, np.unique(np.concatenate([left, right])))
+        local_xy = self.get_local_xy() if lat_to_m is None else None
+        return compute_lanelet_lengths(self.node_store, way_table, lanelet_ids, left, right, lat_to_m, lon_to_m,
+                                       split_dist, local_xy)
+
+    # Prints the length of every lanelet and where to split the long ones. Lengths come from the map's projection,
+    # lat and lon are only kept for old callers
+    def compute_lanelet_length(self, lat=None, lon=None, lanelets=None):
+        table = self.compute_lanelet_lengths(lanelets=lanelets)
+        close_points = table.close_points()
+
+        plans = self.plan_lanelet_splits(table=table)
+        for lanelet, distance, splits in zip(table.lanelet_ids.tolist(), table.lengths, table.splits.tolist()):
+            print(f'lanelet {lanelet} is {int(distance)} m, recommend {splits} splits')
+            if lanelet in plans:
+                left, right, left_cuts, right_cuts = plans[lanelet]
+                print(f'way: {left}, splits: {[self.ways[left].refs[i] for i in left_cuts]}')
+                print(f'way: {right}, splits: {[self.ways[right].refs[i] for i in right_cuts]}')
+        print()
+        for point in close_points.keys():
+            print(f'{point}')
+        return close_points
+
+    # offset_x and offset_y are converted to degrees at the projection origin, or at lat if it's given
+    def set_fixed_offset(self, offset_x=0.0, offset_y=0.0, offset_lat=None, offset_lon=None, lat=None):
+        projection = self.get_projection() if lat is None else None
+        offset_lat, offset_lon = fixed_offset_to_degrees(offset_x, offset_y, offset_lat, offset_lon, lat, projection)
+        print(f'{offset_lat}, {offset_lon}')
+
+        self.header = [offset_georeference_line(line, offset_lat, offset_lon) for line in self.header]
+        for node in self.nodes.values():
+            node.set_lat_lon(node.lat + offset_lat, node.lon + offset_lon)
+        self.nodes_changed()
+
+
+# Function: edit_session
+#
+# Loads an osm file once and hands back its OsmDocument, so any number of edits can be made in memory before the
+# file is written once at the end of the with block. If the block raises, nothing is written
+#
+#    with edit_session(osm_file) as doc:
+#        doc.make_ways_dashed(way_list)
+#        doc.remove_points(points)
+#
+# Parameters:
+#
+#    osm_file - osm file to edit
+#    output_file - where to write the result, defaults to osm_file
+#
+@contextlib.contextmanager
+def edit_session(osm_file, output_file=None):
+    doc = OsmDocument(osm_file)
+    yield doc
+    doc.save(output_file)
+
+
+# Class: BatchResult
+#
+# What happened to one file in run_batch
+#
+# Members:
+#
+#    osm_file - The file
+#    ok - False if an operation raised, in which case the file wasn't written
+#    seconds - Wall time for the whole file, load and save included
+#    step_seconds - [(operation name, seconds), ...] for the operations that ran
+#    error - The traceback if an operation raised, otherwise None
+#
+class BatchResult:
+
+    def __init__(self, osm_file, ok, seconds, step_seconds, error=None):
+        self.osm_file = osm_file
+        self.ok = ok
+        self.seconds = seconds
+        self.step_seconds = step_seconds
+        self.error = error
+
+    def __repr__(self):
+        return f'BatchResult({self.osm_file!r}, ok={self.ok}, seconds={self.seconds:.3f})'
+
+
+# Applies operations to one file in one edit_session. Runs in the worker processes of run_batch
+def run_operations(osm_file, operations):
+    start = time.perf_counter()
+    step_seconds = []
+    try:
+        with edit_session(osm_file) as doc:
+            for operation in operations:
+                if isinstance(operation, str):
+                    operation = (operation, {})
+                name, kwargs = operation if isinstance(operation, tuple) else (operation.__name__, None)
+                step_start = time.perf_counter()
+                if kwargs is None:
+                    operation(doc)
+                else:
+                    getattr(doc, name)(**kwargs)
+                step_seconds.append((name, time.perf_counter() - step_start))
+    except Exception:
+        return BatchResult(osm_file, False, time.perf_counter() - start, step_seconds, traceback.format_exc())
+    return BatchResult(osm_file, True, time.perf_counter() - start, step_seconds)
+
+
+# Function: run_batch
+#
+# Runs the same cleanup over many maps, one file per worker process
+#
+#    run_batch('/maps', ['deduplicate_points', 'remove_orphaned_points', ('set_fixed_offset', {'offset_x': 1.5})])
+#
+# Parameters:
+#
+#    osm_files - list of osm files, a directory to take every .osm file from, or a single osm file
+#    operations - applied in order to each file. Either OsmDocument method names, (method name, kwargs) tuples, or
+#                 module level functions taking the OsmDocument
+#    max_workers - number of processes, defaults to one per core
+#
+# Returns:
+#
+#    A BatchResult per file, in the order of osm_files
+#
+def run_batch(osm_files, operations, max_workers=None):
+    if isinstance(osm_files, (str, os.PathLike)):
+        if os.path.isdir(osm_files):
+            osm_files = [os.path.join(osm_files, name) for name in sorted(os.listdir(osm_files))
+                         if name.endswith('.osm')]
+        else:
+            osm_files = [osm_files]
+    operations = list(operations)
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_operations, osm_file, operations) for osm_file in osm_files]
+        for osm_file, future in zip(osm_files, futures):
+            try:
+                result = future.result()
+            except Exception:
+                result = BatchResult(osm_file, False, 0.0, [], traceback.format_exc())
+            if result.ok:
+                print(f'{osm_file}: {result.seconds:.2f} s')
+            else:
+                print(f'{osm_file}: FAILED after {result.seconds:.2f} s')
+                print(result.error)
+            results.append(result)
+    return results
 
 
 # Function: get_way_data_from_file
@@ -21,57 +2874,15 @@ import os
 #    index - The line in the osm file that it is located at
 #
 def get_way_data_from_file(id, osm_file):
-    # <way id="$id" ...
-    # metadata, just copy
-    # <nd ref=" ...
-    # data, copy line by line
-    # </way>
-
-    start_target = f"<way id=\"{id}\""
-    data_target = "<nd ref="
-    end_target = "</way>"
-    state = 0
-    metadata = []
-    data = []
-    end = []
-
-    with open(osm_file) as f:
-        for i, line in enumerate(f):
-            line_stripped = line.strip()
-            if state == 0 and line_stripped[0:len(start_target)] == start_target:
-                state = 1
-                metadata += [line]
-            elif state == 1:
-                if line_stripped[0:len(data_target)] == data_target:
-                    state = 2
-                    data += [line]
-                else:
-                    metadata += [line]
-            elif state == 2:
-                if line_stripped[0:len(end_target)] == end_target:
-                    end += [line]
-                    index = i
-                    return metadata, data, end, index
-                else:
-                    data += [line]
-    return None, None, None, None
+    way = load_element_index(osm_file).read(osm_file, 'way', id)
+    if way is None:
+        return None, None, None, None
+    return way.metadata, way.data, way.end, way.index
 
 
 def make_way_dashed(way_id, osm_file):
-    target = f'<way id=\"{way_id}\" action=\"modify\" visible=\"true\" version=\"1\">'
-    dashed_tag = f'dashed'
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            contents[i+2] = replace_substring(contents[i+2], dashed_tag, num_to_skip=2)
-            break
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
+    with edit_session(osm_file) as doc:
+        doc.make_way_dashed(way_id)
 
 
 def make_ways_dashed(osm_file, way_list=None):
@@ -85,75 +2896,30 @@ def make_ways_dashed(osm_file, way_list=None):
             else:
                 way_list.append(_)
 
-    for way_id in way_list:
-        make_way_dashed(way_id, osm_file)
+    with edit_session(osm_file) as doc:
+        doc.make_ways_dashed(way_list)
 
 
 def get_lat_lon_from_point(id, osm_file):
-
-    target = f"<node id=\"{id}\" action=\"modify\" visible=\"true\" version=\"1\" lat=\""
-
-    with open(osm_file) as f:
-        for i, line in enumerate(f):
-            line_stripped = line.strip()
-            if line_stripped[0:len(target)] == target:
-                lat_start = len(target)
-                lat_end = line_stripped.index("\"", lat_start)
-                lon_start = line_stripped.index("\"", lat_end+1)+1
-                lon_end = line_stripped.index("\"", lon_start)
-                lat = float(line_stripped[lat_start:lat_end])
-                lon = float(line_stripped[lon_start:lon_end])
-                return lat, lon
-    return None, None
+    node = load_element_index(osm_file).read(osm_file, 'node', id)
+    if node is None:
+        return None, None
+    return node.lat, node.lon
 
 
 def change_lanelet_boundary(lanelet, current_boundary, updated_boundary, osm_file):
-
-    start_target = f"<relation id=\"{lanelet}\" action=\"modify\" visible=\"true\" version=\"1\">"
-    data_target = f"<member type=\"way\" ref=\"{current_boundary}"
-    boundary_metadata_left = "<member type=\"way\" ref=\""
-    boundary_metadata_right = "\" role=\"right\"/>"
-    state = 0
-
-    with open(osm_file) as f:
-        for i, line in enumerate(f):
-            line_stripped = line.strip()
-            if state == 0 and line_stripped == start_target:
-                # Found the lanelet, now we need to check the lanelet boundaries
-                state = 1
-            elif state == 1:
-                if line_stripped[0:len(data_target)] == data_target:
-                    boundary_metadata_left = line[:line.index(boundary_metadata_left)] + boundary_metadata_left
-                    boundary_metadata_right = line[len(boundary_metadata_left) + len(str(current_boundary)):]
-                    new_line = boundary_metadata_left + str(updated_boundary) + boundary_metadata_right
-                    return new_line, i
-                else:
-                    state = 2
-            elif state == 2:
-                if line_stripped[0:len(data_target)] == data_target:
-                    boundary_metadata_left = line[:line.index(boundary_metadata_left)] + boundary_metadata_left
-                    boundary_metadata_right = line[len(boundary_metadata_left) + len(str(current_boundary)):]
-                    new_line = boundary_metadata_left + str(updated_boundary) + boundary_metadata_right
-                    return new_line, i
-                else:
-                    return None, None
-
-    return None, None
+    with edit_session(osm_file) as doc:
+        new_line = doc.change_lanelet_boundary(lanelet, current_boundary, updated_boundary)
+    return new_line
 
 
 def get_lat_lon_from_data_line(line, osm_file):
-    id = line[line.index("\"") + 1:line.rindex("\"")]
-    lat_lon = get_lat_lon_from_point(id, osm_file)
+    lat_lon = get_lat_lon_from_point(get_attribute(line, 'ref'), osm_file)
     return lat_lon
 
 
 def compute_lanelet_boundary_angle(data_lines, osm_file):
-    data_center1 = data_lines[(len(data_lines) - 1) // 2]
-    lat_1, lon_1 = get_lat_lon_from_data_line(data_center1, osm_file)
-    data_center2 = data_lines[(len(data_lines) - 1) // 2 + 1]
-    lat_2, lon_2 = get_lat_lon_from_data_line(data_center2, osm_file)
-    angle = np.arctan2(lat_2 - lat_1, lon_2 - lon_1)
-    return angle
+    return OsmDocument(osm_file).compute_lanelet_boundary_angle(data_lines)
 
 
 def replace_substring(string, substring, start_char="\"", end_char="\"", num_to_skip=0):
@@ -186,82 +2952,21 @@ def get_substring(string, start_char="\"", end_char="\"", num_to_skip=0):
 
 # Given a doubled lanelet boundary, get the lanelets associated with it and the other boundary of each
 def get_boundaries_lanelets_from_doubled_boundary(doubled_boundary, osm_file):
-
-    lanelet_target = f"<relation id=\""
-    doubled_boundary_target = f"<member type=\"way\" ref=\"{doubled_boundary}\""
-    doubled_data = [int(doubled_boundary)]
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped[0:len(doubled_boundary_target)] == doubled_boundary_target:
-            # We have a lanelet and other boundary
-            # Either it is Lanelet -> this -> other boundary, or Lanelet -> other boundary -> this
-            # Check if it's Lanelet -> this -> other boundary
-            if (contents[i-1].strip())[0:len(lanelet_target)] == lanelet_target:
-                # This is the lanelet
-                doubled_data.append(int(get_substring(contents[i - 1])))
-                # This is the other boundary
-                doubled_data.append(int(get_substring(contents[i + 1], num_to_skip=2)))
-            else:
-                # This is the lanelet
-                doubled_data.append(int(get_substring(contents[i - 2])))
-                # This is the other boundary
-                doubled_data.append(int(get_substring(contents[i - 1], num_to_skip=2)))
-
-        if len(doubled_data) >= 5:
-            return doubled_data
-
-    return None
+    return OsmDocument(osm_file).get_boundaries_lanelets_from_doubled_boundary(doubled_boundary)
 
 
 def get_doubled_centerlines(osm_file):
-    # dict = {}
-    # with open("/home/alex/Downloads/xodr/McLean_Loop.osm") as infile:
-    #     infile.readline()
-
-    target = "<member type=\"way\" ref=\""
-
-    with open(osm_file) as f:
-        seen = set()
-        prior = ""
-        twoprior = ""
-        dupes = 0
-        doubled_boundary_datas = []
-        for line in f:
-            try:
-                start_index = line.index(target) + len(target)
-                end_index = line.index("\"", len(line) - 5)
-                to_check = line[start_index:end_index]
-                # if to_check[0:6] == "117711":
-                #     print('hi')
-                if to_check in seen:
-                    # print(twoprior, end="")
-                    # print(prior, end="")
-                    # print(line, end="")
-                    # print()
-                    dupes += 1
-                    doubled_boundary = get_substring("\"" + to_check)
-                    doubled_boundary_data = get_boundaries_lanelets_from_doubled_boundary(doubled_boundary, osm_file)
-                    doubled_boundary_datas.append(doubled_boundary_data)
-                else:
-                    seen.add(to_check)
-            except:
-                tmp = 2
-            twoprior = prior
-            prior = line
-    print(dupes)
-    return doubled_boundary_datas
+    return OsmDocument(osm_file).get_doubled_centerlines()
 
 
 # doubled_boundaries:
+#   DoubledBoundary records from get_doubled_centerlines, or lists of
 #   [ id of doubled boundary
 #     id of lanelet 1
 #     id of other boundary of lanelet 1
 #     id of lanelet 2
 #     id of other boundary of lanelet 2 ]
+#   or None to find them in the same pass
 # osm_map:
 #   string, absolute path to the osm file
 def fix_doubled_centerlines(doubled_boundaries, osm_file):
@@ -276,98 +2981,21 @@ def fix_doubled_centerlines(doubled_boundaries, osm_file):
     #           Get the other boundary assocated with each lanelet
     #       dir = atan2(y2-y1, x2-x1)
     #   The odd one out is the error lanelet/boundary
-    #       compute diffs to doubled, the larger one is associated with the error lanelet
+    #       compute diffs to doubled, wrapped into [0, pi], the larger one is associated with the error lanelet
     # Create a reversed copy of the boundary, associated with the error lanelet
     #   Copy the metadata
     #   Copy and reverse the points
+    # Every heading is computed at once, and all the reversed copies are written in one save
 
-    # new_osm = osm_file[:-4] + '_fixed.osm'
-
-    for doubled_boundary_data in doubled_boundaries:
-        # Grab the error lanelet associated with the boundary
-        [doubled_boundary, lanelet1, lanelet1_boundary, lanelet2, lanelet2_boundary] = doubled_boundary_data
-        #   Get the direction of this boundary
-        #       Grab the center point, or very near there
-        #       dir = atan2(y2-y1, x2-x1)
-        metadata, data, end, index = get_way_data_from_file(doubled_boundary, osm_file)
-        dir_doubled = compute_lanelet_boundary_angle(data, osm_file)
-        #   Get the direction of each associated lanelet
-        #       Get the other 2 lanelet boundaries
-        #           Get the 2 lanelets associated with this boundary
-        #           Get the other boundary assocated with each lanelet
-        #       dir = atan2(y2-y1, x2-x1)
-        metadata1, data1, end1, _ = get_way_data_from_file(lanelet1_boundary, osm_file)
-        dir_1 = compute_lanelet_boundary_angle(data1, osm_file)
-        metadata2, data2, end2, _ = get_way_data_from_file(lanelet2_boundary, osm_file)
-        dir_2 = compute_lanelet_boundary_angle(data2, osm_file)
-        #   The odd one out is the error lanelet/boundary
-        #       compute diffs to doubled, the larger one is associated with the error lanelet
-        diff_1 = abs(dir_1 - dir_doubled)
-        diff_2 = abs(dir_2 - dir_doubled)
-        if diff_1 >= diff_2:
-            # It's lanelet 1 and boundary
-            print(lanelet1)
-            lanelet_to_update = lanelet1
-            boundary_to_update = lanelet1_boundary
-        else:
-            # It's lanelet 2 and boundary
-            print(lanelet2)
-            lanelet_to_update = lanelet2
-            boundary_to_update = lanelet2_boundary
-
-        # Create a reversed copy of the boundary, associated with the error lanelet
-        #   Copy the metadata
-        #   Copy and reverse the points
-        with open(osm_file) as f:
-            contents = f.readlines()
-
-        start_index = index + 1
-        flipped_data = list(np.flip(data))
-        edited_boundary_id = int(str(doubled_boundary) + '99')
-        metadata[0] = replace_substring(metadata[0], str(edited_boundary_id))
-        data_list = metadata + flipped_data + end
-
-        updated_line, index = change_lanelet_boundary(lanelet_to_update, doubled_boundary, edited_boundary_id, osm_file)
-        contents[index] = updated_line
-
-        for i, data in enumerate(data_list):
-            contents.insert(start_index + i, data)
-
-        os.remove(osm_file)
-        with open(osm_file, "a+") as f:
-            f.writelines(contents)
-
-    print('done')
+    with edit_session(osm_file) as doc:
+        if doubled_boundaries is None:
+            doubled_boundaries = doc.get_doubled_centerlines()
+        return doc.fix_doubled_centerlines(doubled_boundaries)
 
 
 def reverse_way(lanelet_id, way_id, osm_file, create_new=False):
-    metadata, data, end, index = get_way_data_from_file(way_id, osm_file)
-
-    # Create a reversed copy of the boundary, associated with the error lanelet
-    #   Copy the metadata
-    #   Copy and reverse the points
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    start_index = index + 1
-    flipped_data = list(np.flip(data))
-
-    if create_new:
-        edited_boundary_id = int(str(way_id) + '99')
-        metadata[0] = replace_substring(metadata[0], str(edited_boundary_id))
-        data_list = metadata + flipped_data + end
-        updated_line, index = change_lanelet_boundary(lanelet_id, way_id, edited_boundary_id, osm_file)
-
-    data_list = metadata + flipped_data + end
-    updated_line, index = change_lanelet_boundary(lanelet_id, way_id, way_id, osm_file)
-    contents[index] = updated_line
-
-    for i, data in enumerate(data_list):
-        contents.insert(start_index + i, data)
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
+    with edit_session(osm_file) as doc:
+        doc.reverse_way(lanelet_id, way_id, create_new)
 
 
 def reverse_lanelets(osm_file, lanelet_list=None):
@@ -381,61 +3009,33 @@ def reverse_lanelets(osm_file, lanelet_list=None):
                 break
             else:
                 lanelet_list.append(_)
-    elif lanelet_list == 'all':
-        lanelet_list = get_all_lanelets_from_file(osm_file)
 
-    ways = {}
-    for lanelet_id in lanelet_list:
-        way1, way2 = get_ways_from_lanelet(lanelet_id, osm_file)
-        ways[str(way1)] = lanelet_id
-        ways[str(way2)] = lanelet_id
-
-    for way in ways.keys():
-        try:
-            reverse_way(ways[way], int(way), osm_file)
-        except:
-            print(f'got bad lanelet, I think: {way} - {ways[way]}')
+    with edit_session(osm_file) as doc:
+        doc.reverse_lanelets(lanelet_list)
 
 
 def get_ways_from_lanelet(lanelet_id, osm_file):
-    start_target = f"<relation id=\"{lanelet_id}\" action=\"modify\" visible=\"true\" version=\"1\">"
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped == start_target:
-            way1_id = get_substring(contents[i + 1], num_to_skip=2)
-            way2_id = get_substring(contents[i + 2], num_to_skip=2)
-
-            return way1_id, way2_id
-
-    print(f'problems finding lanelet {lanelet_id}')
-    return None, None
+    return OsmDocument(osm_file).get_ways_from_lanelet(lanelet_id)
 
 
 def grab_start_and_end_points_from_way(way_id, osm_file):
-    metadata, data, end, index = get_way_data_from_file(way_id, osm_file)
-    return data[0], data[-1]
+    way = load_element_index(osm_file).read(osm_file, 'way', way_id)
+    return way.refs[0], way.refs[-1]
 
 
 def globally_replace_point_return_contents(replacer, replacee, contents):
 
-    target = f"<nd ref=\"{replacee}\""
-    delete_target = f"<node id=\"{replacee}\""
-
     # with open(osm_file) as f:
     #     contents = f.readlines()
 
     for i, line in enumerate(contents):
-        if (line.strip())[0:len(delete_target)] == delete_target:
+        if is_element_line(line, NODE_START, replacee):
             del contents[i]
             break
 
     for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            contents[i] = replace_substring(line, str(replacer))
+        if line.lstrip().startswith(ND_START) and get_attribute(line, 'ref') == str(replacee):
+            contents[i] = set_attribute(line, 'ref', str(replacer))
 
     # os.remove(osm_file)
     # with open(osm_file, "a+") as f:
@@ -444,29 +3044,25 @@ def globally_replace_point_return_contents(replacer, replacee, contents):
 
 
 def globally_replace_point(replacer, replacee, osm_file):
+    with edit_session(osm_file) as doc:
+        doc.globally_replace_point(replacer, replacee)
 
-    target = f"<nd ref=\"{replacee}\""
-    delete_target = f"<node id=\"{replacee}\""
-    data_list = []
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(delete_target)] == delete_target:
-            del contents[i]
-            break
-
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            contents[i] = replace_substring(line, str(replacer))
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
 
-
-def check_lanelets_for_route(lanelet_list, osm_file, route_file):
+# Function: check_lanelets_for_route
+#
+# Checks that a lanelet sequence can be driven, using a LaneletGraph built from the map
+#
+# Parameters:
+#
+#    lanelet_list - lanelet ids in driving order, or None to type them in
+#    osm_file - map to build the graph from
+#    route_file - optional route graph DOT file. It is read once, and any step the two graphs disagree on is printed
+#
+# Returns:
+#
+#    Index in lanelet_list of the first break, or None if the whole sequence is routable
+#
+def check_lanelets_for_route(lanelet_list, osm_file, route_file=None):
 
     if lanelet_list is None:
         lanelet_list = []
@@ -478,118 +3074,168 @@ def check_lanelets_for_route(lanelet_list, osm_file, route_file):
             else:
                 lanelet_list.append(_)
 
-    with open(route_file) as f:
-        contents = f.readlines()
-
-    translated_last = -1
-    untranslated_last = 'INVALID'
-    for lanelet in lanelet_list:
-        table_target = f"[label=\"{lanelet}\" lanelet=\"{lanelet}\"];"
-        for i, line in enumerate(contents):
-            if (line.strip())[len(line) - len(table_target) - 1:] == table_target:
-                translated = line[0:len(line) - len(table_target) - 1]
-                print(f'lanelet {lanelet} is {translated}')
-                target = f"{translated_last}->{translated}"
-                print(f"Checking {target}")
-                found = False
-                for j, line2 in enumerate(contents):
-                    if (line2.strip())[0:len(target)] == target:
-                        found = True
-                        print(line2, end='')
-                if not found and untranslated_last != 'INVALID':
-                    print(f'-----------------{untranslated_last}->{lanelet} Not found------------------')
-                    # way1, way2 = grab_ways_from_lanelet(untranslated_last, osm_file)
-                    # print(grab_start_and_end_points_from_way(way1, osm_file))
-                    # print(grab_start_and_end_points_from_way(way2, osm_file))
-                    #
-                    # way1, way2 = grab_ways_from_lanelet(lanelet, osm_file)
-                    # print(grab_start_and_end_points_from_way(way1, osm_file))
-                    # print(grab_start_and_end_points_from_way(way2, osm_file))
-                    #
-                    # replacer = int(input('Enter point to replace it with: '))
-                    # replacee = int(input('Enter point to be replaced: '))
-                    # globally_replace_point(replacer, replacee, osm_file)
-                    # print()
-                translated_last = translated
-                untranslated_last = lanelet
+    graph = OsmDocument(osm_file).get_lanelet_graph()
+    route_graph = LaneletGraph.from_dot(route_file) if route_file is not None else None
+
+    for previous, lanelet in zip(lanelet_list, lanelet_list[1:]):
+        in_map = graph.has_edge(previous, lanelet)
+        if route_graph is not None and route_graph.has_edge(previous, lanelet) != in_map:
+            print(f'{previous}->{lanelet} is {"" if in_map else "not "}connected in the map but '
+                  f'{"not " if in_map else ""}in the route file')
+
+    first_break = graph.first_break(lanelet_list)
+    if first_break is not None:
+        print(f'-----------------{lanelet_list[first_break - 1]}->{lanelet_list[first_break]} Not found------------------')
+    return first_break
+
+
+# Function: load_routing_graph
+#
+# The RoutingGraph of an osm file, from the cache next to it when that was built from the same file contents.
+# Otherwise the map is parsed and the cache rewritten. Like the document cache, a matching size and mtime is trusted
+# without hashing the map, and the hash is only checked when just the mtime changed. A cache that can't be written,
+# e.g. next to a map in a read-only directory, is skipped
+#
+# Parameters:
+#
+#    osm_file - map to route on
+#    lane_change_cost - cost in m of a lane change
+#    cache_file - where to keep the graph, defaults to <osm_file>.route.npz. False to not cache
+#
+def load_routing_graph(osm_file, lane_change_cost=0.0, cache_file=None):
+    if cache_file is None:
+        cache_file = osm_file + '.route.npz'
+    # tmerc marks graphs weighted with projected lengths, so caches from the degree-scale weights are rebuilt
+    suffix = f':{lane_change_cost!r}:tmerc'
+    size, mtime = document_cache_key(osm_file)
+    fingerprint = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            graph = RoutingGraph.load(cache_file)
+            if graph.size == size and graph.fingerprint.endswith(suffix):
+                if graph.mtime == mtime:
+                    return graph
+                fingerprint = map_fingerprint(osm_file) + suffix
+                if graph.fingerprint == fingerprint:
+                    graph.mtime = mtime
+                    save_routing_graph(graph, cache_file)
+                    return graph
+        except CACHE_READ_ERRORS:
+            pass
+
+    if fingerprint is None:
+        fingerprint = map_fingerprint(osm_file) + suffix
+    graph = OsmDocument(osm_file).get_routing_graph(lane_change_cost, fingerprint)
+    graph.size, graph.mtime = size, mtime
+    if cache_file:
+        save_routing_graph(graph, cache_file)
+    return graph
+
+
+# Saves a routing graph cache, keeping quiet if it can't be written
+def save_routing_graph(graph, cache_file):
+    try:
+        graph.save(cache_file)
+    except OSError:
+        pass
+
+
+# Shortest lanelet route from start to goal as ([start, ..., goal], cost in m), or (None, inf)
+def route_lanelets(start, goal, osm_file, lane_change_cost=0.0):
+    return load_routing_graph(osm_file, lane_change_cost).shortest_path(start, goal)
 
 
 def deduplicate_points(osm_file):
+    with edit_session(osm_file) as doc:
+        return doc.deduplicate_points()
 
-    target = "<node id=\""
 
-    with open(osm_file) as f:
-        contents = f.readlines()
+# Function: merge_nearby_points
+#
+# Merges nodes closer than tolerance m to each other, see OsmDocument.merge_nearby_points
+#
+def merge_nearby_points(osm_file, tolerance=0.05):
+    with edit_session(osm_file) as doc:
+        return doc.merge_nearby_points(tolerance)
 
-    edited_contents = contents.copy()
-    seen = {}
-    dupes = 0
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            id = int(get_substring(line, num_to_skip=0))
-            lat = get_substring(line, num_to_skip=8)
-            lon = get_substring(line, num_to_skip=10)
-            key = f"{lat}_{lon}"
-            if key in seen.keys():
-                print(f'line: {i}, id: {id}')
-                dupes += 1
-                edited_contents = globally_replace_point_return_contents(seen[key], id, edited_contents)
-            else:
-                seen[key] = id
 
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(edited_contents)
+# Function: find_nodes_near
+#
+# Nodes within radius m of a latitude and longitude, e.g. one copied out of JOSM. Distances are measured in the
+# map's projection, see OsmDocument.get_projection
+#
+# Returns:
+#
+#    Sorted array of node ids
+#
+def find_nodes_near(osm_file, lat, lon, radius):
+    doc = OsmDocument(osm_file)
+    x, y = doc.get_projection().project(lat, lon)
+    return doc.find_nodes_near(float(x), float(y), radius)
 
-    print(dupes)
-    print(i)
-    return
 
+# Function: find_nodes_in_box
+#
+# Nodes with min_lat <= lat <= max_lat and min_lon <= lon <= max_lon
+#
+# Returns:
+#
+#    Sorted array of node ids
+#
+def find_nodes_in_box(osm_file, min_lat, min_lon, max_lat, max_lon):
+    doc = OsmDocument(osm_file)
+    min_x, min_y, max_x, max_y = projected_box(doc.get_projection(), min_lat, min_lon, max_lat, max_lon)
+    ids = doc.find_nodes_in_box(min_x, min_y, max_x, max_y)
+    # The projected box covers the lat/lon box, so the nodes in its corners are dropped here
+    lats, lons = doc.node_store.lat_lon(ids)
+    return ids[(lats >= min_lat) & (lats <= max_lat) & (lons >= min_lon) & (lons <= max_lon)]
 
-def remove_orphaned_points(osm_file):
 
-    node_definition = "<node id=\""
-    used_in_way = "<nd ref=\""
+# Function: find_lanelets_near
+#
+# Lanelets within radius m of a latitude and longitude, see OsmDocument.find_lanelets_near. Handy for finding the
+# lanelets around a route break check_lanelets_for_route reports
+#
+# Returns:
+#
+#    (lanelet ids, distances in m), nearest first
+#
+def find_lanelets_near(osm_file, lat, lon, radius):
+    doc = OsmDocument(osm_file)
+    x, y = doc.get_projection().project(lat, lon)
+    return doc.find_lanelets_near(float(x), float(y), radius)
 
-    with open(osm_file) as f:
-        contents = f.readlines()
 
-    seen = {}
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(node_definition)] == node_definition:
-            id = int(get_substring(line, num_to_skip=0))
-            key = f"{id}"
-            seen[key] = -1
+# Function: find_lanelets_in_box
+#
+# Lanelets whose projected bounding box intersects the projection of a lat/lon box
+#
+# Returns:
+#
+#    Sorted array of lanelet ids
+#
+def find_lanelets_in_box(osm_file, min_lat, min_lon, max_lat, max_lon):
+    doc = OsmDocument(osm_file)
+    return doc.find_lanelets_in_box(*projected_box(doc.get_projection(), min_lat, min_lon, max_lat, max_lon))
 
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(used_in_way)] == used_in_way:
-            id = int(get_substring(line, num_to_skip=0))
-            key = f"{id}"
-            seen[key] = int(key)
-    print(len(contents))
-    offset = 0
-    for i in range(len(contents)):
-        i += offset
-        line = contents[i]
-        if (line.strip())[0:len(node_definition)] == node_definition:
-            id = int(get_substring(line, num_to_skip=0))
-            key = f"{id}"
-            if seen[key] == -1:
-                del contents[i]
-                offset -= 1
-    print(len(contents))
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
-    return
 
+# (min x, min y, max x, max y) covering a lat/lon box in a projection. Points along every edge are projected, not
+# just the corners, as meridians and parallels curve away from the origin
+def projected_box(projection, min_lat, min_lon, max_lat, max_lon, samples=9):
+    along_lat = np.linspace(min_lat, max_lat, samples)
+    along_lon = np.linspace(min_lon, max_lon, samples)
+    lats = np.concatenate([along_lat, along_lat, np.full(samples, min_lat), np.full(samples, max_lat)])
+    lons = np.concatenate([np.full(samples, min_lon), np.full(samples, max_lon), along_lon, along_lon])
+    x, y = projection.project(lats, lons)
+    return float(x.min()), float(y.min()), float(x.max()), float(y.max())
+
+
+def remove_orphaned_points(osm_file):
+    with edit_session(osm_file) as doc:
+        return doc.remove_orphaned_points()
 
-def remove_lanelets_except(osm_file, lanelets_to_keep=None):
-    target = f"<relation id=\""
-    lanelet_line_2 = f"<member type=\""
-    regulatory_line_2 = f"<tag k=\"type\" v=\"regulatory_element\"/>"
 
+def remove_lanelets_except(osm_file, lanelets_to_keep=None):
     if lanelets_to_keep is None:
         lanelets_to_keep = []
         print('Enter lanelets to keep, type stop to process them')
@@ -600,9 +3246,6 @@ def remove_lanelets_except(osm_file, lanelets_to_keep=None):
             else:
                 lanelets_to_keep.append(_)
 
-    with open(osm_file) as f:
-        contents = f.readlines()
-
     '''
       <relation id="274" action="modify" visible="true" version="1">
         <tag k="type" v="regulatory_element"/>
@@ -613,61 +3256,42 @@ def remove_lanelets_except(osm_file, lanelets_to_keep=None):
       </relation>
     '''
 
-    all_lanelets = []
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            if (contents[i+1].strip())[0:len(lanelet_line_2)] == lanelet_line_2:
-                lanelet_id = int(get_substring(line, num_to_skip=0))
-                all_lanelets.append(lanelet_id)
-            if (contents[i+1].strip())[0:len(regulatory_line_2)] == regulatory_line_2:
-                ref_line = contents[i+5].strip()
-                ref = int(get_substring(ref_line, num_to_skip=2))
-                if str(ref) not in lanelets_to_keep:
-                    lanelet_id = int(get_substring(line, num_to_skip=0))
-                    all_lanelets.append(lanelet_id)
-
-    print(f'total num lanelets {len(all_lanelets)}, num to keep is {len(lanelets_to_keep)}')
-    delta = len(all_lanelets) - len(lanelets_to_keep)
-    count = 0
-
-    for lanelet in all_lanelets:
-        if str(lanelet) not in lanelets_to_keep:
-            remove_lanelet(lanelet, osm_file, False)
-            count += 1
-            if count % (delta // 10) == 0:
-                print(f'{count / delta * 100} percent complete')
+    return extract_lanelets(osm_file, lanelets_to_keep)
 
-    remove_orphaned_points(osm_file)
-    return
+
+# Function: extract_lanelets
+#
+# Writes a map holding only the given lanelets and everything they need, see OsmDocument.get_lanelet_closure.
+# The map is read once and the kept elements written once, however many lanelets are dropped
+#
+# Parameters:
+#
+#    osm_file - osm file to read
+#    lanelet_ids - lanelets to keep
+#    output_file - where to write the result, defaults to osm_file
+#
+# Returns:
+#
+#    A dict of how many nodes, ways and relations were kept
+#
+def extract_lanelets(osm_file, lanelet_ids, output_file=None):
+    doc = OsmDocument(osm_file)
+    keep = doc.get_lanelet_closure(lanelet_ids)
+    doc.save(output_file, keep)
+    return {kind: len(ids) for kind, ids in keep.items()}
 
 
 def remove_lanelet(lanelet_id, osm_file, remove_orphans=True):
     # remove the lanelet definition and the two boundary ways, then call remove_orphaned_points to clean up the rest.'
-    way1, way2 = get_ways_from_lanelet(lanelet_id, osm_file)
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    remove_way(way1, contents)
-    remove_way(way2, contents)
-    remove_lanelet_header(lanelet_id, contents)
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
-
-    if remove_orphans:
-        remove_orphaned_points(osm_file)
-    return
+    with edit_session(osm_file) as doc:
+        doc.remove_lanelet(lanelet_id, remove_orphans)
 
 
 def remove_lanelet_header(lanelet_id, contents):
-    delete_target = f"<relation id=\"{lanelet_id}\""
     end_target = "</relation>"
 
     for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped[0:len(delete_target)] == delete_target:
+        if is_element_line(line, RELATION_START, lanelet_id):
             del contents[i]
             while True:
                 line_stripped = contents[i].strip()
@@ -681,37 +3305,21 @@ def remove_lanelet_header(lanelet_id, contents):
 
 
 def remove_points(points, osm_file):
-    for point in points:
-        remove_point(point, osm_file)
+    with edit_session(osm_file) as doc:
+        doc.remove_points(points)
 
 
 def remove_point(point_id, osm_file):
-    definition_target = f"<node id=\"{point_id}\""
-    use_target = f"<nd ref=\"{point_id}\""
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(definition_target)] == definition_target\
-                or (line.strip())[0:len(use_target)] == use_target:
-            del contents[i]
-            print(f'removed {point_id}')
-            # break
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
+    with edit_session(osm_file) as doc:
+        doc.remove_point(point_id)
 
 
 def remove_way(way_id, contents):
 
-    delete_target = f"<way id=\"{way_id}\""
     end_target = "</way>"
 
     for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped[0:len(delete_target)] == delete_target:
+        if is_element_line(line, WAY_START, way_id):
             del contents[i]
             while True:
                 line_stripped = contents[i].strip()
@@ -726,306 +3334,329 @@ def remove_way(way_id, contents):
 
 def globally_replace_way_return_contents(replacer, replacee, contents):
 
-    target = f"<member type=\"way\" ref=\"{replacee}\""
-
     contents = remove_way(replacee, contents)
 
     for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            contents[i] = replace_substring(line, str(replacer), num_to_skip=2)
+        if line.lstrip().startswith(MEMBER_START) and get_attribute(line, 'type') == 'way' \
+                and get_attribute(line, 'ref') == str(replacee):
+            contents[i] = set_attribute(line, 'ref', str(replacer))
 
     return contents
 
 
-def deduplicate_ways(osm_file):
-
-    target = "<way id=\""
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    edited_contents = contents.copy()
-    seen = {}
-    dupes = 0
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            way_id = int(get_substring(line, num_to_skip=0))
-            first, last = grab_start_and_end_points_from_way(way_id, osm_file)
-            key = f"{first}_{last}"
-            if key in seen.keys():
-                print(f'line: {i}, id: {way_id}')
-                dupes += 1
-                edited_contents = globally_replace_way_return_contents(seen[key], way_id, edited_contents)
-            else:
-                seen[key] = way_id
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(edited_contents)
-
-    print(dupes)
-    print(i)
-    return
+def deduplicate_ways(osm_file, endpoints_only=False, merge_reversed=False):
+    with edit_session(osm_file) as doc:
+        return doc.deduplicate_ways(endpoints_only, merge_reversed)
 
 
 def get_all_lanelets_from_file(osm_file):
-    target = f"<relation id=\""
-    lanelet_line_2 = f"<member type=\""
+    return OsmDocument(osm_file).get_all_lanelets()
 
-    with open(osm_file) as f:
-        contents = f.readlines()
 
-    lanelet_ids = []
-    for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped[0:len(target)] == target:
-            if (contents[i+1].strip())[0:len(lanelet_line_2)] == lanelet_line_2:
-                lanelet_id = int(get_substring(line_stripped, num_to_skip=0))
-                lanelet_ids.append(lanelet_id)
+def compute_way_length_from_file(osm_file, way, lat_to_m=None, lon_to_m=None):
+    return OsmDocument(osm_file).compute_way_length(way, lat_to_m, lon_to_m)
 
-    return lanelet_ids
 
+def get_largest_id_from_file(osm_file):
+    return OsmDocument(osm_file).get_largest_id()
 
-def compute_way_length_from_file(osm_file, way, lat_to_m, lon_to_m):
-    # print(f'starting way {way}')
-    distance = 0
-    too_close = []
 
-    metadata, data, end, index = get_way_data_from_file(way, osm_file)
-    distances = np.zeros(len(data))
+# Splits the lanelet into pieces about split_dist long, see OsmDocument.split_lanelets
+def split_lanelet_by_dist_from_file(osm_file, lanelet, way1, way2, split_dist, lat_to_m=None, lon_to_m=None):
+    with edit_session(osm_file) as doc:
+        return doc.split_lanelet_by_dist(lanelet, way1, way2, split_dist, lat_to_m, lon_to_m)
 
-    last_point = int(get_substring(data[0], num_to_skip=0))
-    last_lat, last_lon = get_lat_lon_from_point(last_point, osm_file)
-    for i in range(len(data) // 2):
-        point_text = data[i]
-        point = int(get_substring(point_text, num_to_skip=0))
-        lat, lon = get_lat_lon_from_point(point, osm_file)
 
-        delta_m_lat = lat_to_m * (lat - last_lat)
-        delta_m_lon = lon_to_m * (lon - last_lon)
-        dist_step = np.sqrt(delta_m_lat**2 + delta_m_lon**2)
+# Function: split_long_lanelets
+#
+# Splits every lanelet that compute_lanelet_length flags as too long, in one load and one write
+#
+# Parameters:
+#
+#    osm_file - osm file to edit
+#    split_dist - target lanelet length in m
+#    lanelets - lanelets to consider, or None for all of them
+#
+# Returns:
+#
+#    {lanelet: [lanelet, new lanelet, ...]} for every lanelet that was split
+#
+def split_long_lanelets(osm_file, split_dist=150.0, lanelets=None):
+    with edit_session(osm_file) as doc:
+        return doc.split_lanelets(lanelets=lanelets, split_dist=split_dist)
 
-        if i > 0:
-            if dist_step < 2.0:
-                too_close.append(point)
-            else:
-                distance += dist_step
-                distances[i] = dist_step
-                last_lat, last_lon = lat, lon
-
-    last_point = int(get_substring(data[-1], num_to_skip=0))
-    last_lat, last_lon = get_lat_lon_from_point(last_point, osm_file)
-    for i in range(len(data) - 1, len(data) // 2 - 2, -1):
-        point_text = data[i]
-        point = int(get_substring(point_text, num_to_skip=0))
-        lat, lon = get_lat_lon_from_point(point, osm_file)
-
-        delta_m_lat = lat_to_m * (lat - last_lat)
-        delta_m_lon = lon_to_m * (lon - last_lon)
-        dist_step = np.sqrt(delta_m_lat ** 2 + delta_m_lon ** 2)
-
-        if i < len(data) - 1:
-            if dist_step < 2.0:
-                too_close.append(point)
-            else:
-                distance += dist_step
-                distances[i] = dist_step
-                last_lat, last_lon = lat, lon
 
-    return distance, distances, too_close
+def compute_lanelet_length(osm_file, lat=None, lon=None, lanelets=None):
+    return OsmDocument(osm_file).compute_lanelet_length(lat, lon, lanelets)
 
 
-def get_largest_id_from_file(osm_file):
-    # relation id
-    # node id
-    # way id
-    target1 = f"<node id=\""
-    target2 = f"<way id=\""
-    target3 = f"<relation id=\""
-    target4 = "<member type=\"relation\" ref=\""
-
-    with open(osm_file) as f:
-        contents = f.readlines()
-
-    max = 0
-    for i, line in enumerate(contents):
-        line_stripped = line.strip()
-        if line_stripped[0:len(target1)] == target1\
-                or line_stripped[0:len(target2)] == target2\
-                or line_stripped[0:len(target3)] == target3:
-            id = int(get_substring(line_stripped, num_to_skip=0))
-            if id > max:
-                max = id
-        elif line_stripped[0:len(target4)] == target4:
-            id = int(get_substring(line_stripped, num_to_skip=2))
-            if id > max:
-                max = id
-
-    return max
-
-
-# Currently just prints the lanelets that need to be split, along with the specicific node(s) to split it on
-def split_lanelet_by_dist_from_file(osm_file, lanelet, way1, way2, split_dist, lat_to_m, lon_to_m):
-
-    max_id = get_largest_id_from_file(osm_file)
-    way1_length, way1_dists, _ = compute_way_length_from_file(osm_file, way1, lat_to_m, lon_to_m)
-    way2_length, way2_dists, _ = compute_way_length_from_file(osm_file, way2, lat_to_m, lon_to_m)
-    metadata1, data1, end1, index1 = get_way_data_from_file(way1, osm_file)
-    metadata2, data2, end2, index2 = get_way_data_from_file(way2, osm_file)
-
-    # compute split target path lengths (keep them reasonably the same length)
-    splits = int(way1_length // split_dist) + 1
-    if splits > 0 and splits % way1_length < (split_dist // 3):  # Allow the lanelets to be a smidge longer
-        splits -= 1
-    length = way1_length / splits
-
-    data1 = np.array(data1)
-    data2 = np.array(data2)
-    length_indices = []
-    for i in range(splits):
-        sum_dist = 0
-        for j, incremental_dist in enumerate(way1_dists):
-            sum_dist += incremental_dist
-            if sum_dist > length * (i+1):
-                length_indices.append(j)
-                break
+# Function: set_fixed_offset
+#
+# Shifts every node, and the geoReference origin, by a fixed offset
+#
+# Parameters:
+#
+#    osm_file - osm file to edit
+#    offset_x, offset_y - offset in m, used when offset_lon/offset_lat aren't given
+#    offset_lat, offset_lon - offset in degrees
+#    lat - latitude used to convert offset_x to degrees, defaults to the map's projection, see read_projection
+#    streaming - rewrite the file line by line with constant memory instead of loading it into an OsmDocument
+#
+def set_fixed_offset(osm_file, offset_x=0.0, offset_y=0.0, offset_lat=None, offset_lon=None, lat=None,
+                     streaming=True):
+    if not streaming:
+        with edit_session(osm_file) as doc:
+            doc.set_fixed_offset(offset_x, offset_y, offset_lat, offset_lon, lat)
+        return
+
+    projection = None
+    if lat is None and (offset_lat is None or offset_lon is None):
+        projection = read_projection(osm_file)
+    offset_lat, offset_lon = fixed_offset_to_degrees(offset_x, offset_y, offset_lat, offset_lon, lat, projection)
+    print(f'{offset_lat}, {offset_lon}')
+    write_lines_atomic(osm_file, offset_lines(read_lines(osm_file), offset_lat, offset_lon))
 
-    print(f'way: {way1}, splits: {data1[length_indices]}')
-    print(f'way: {way2}, splits: {data2[length_indices]}')
-    print(f'associated lanelet: {lanelet}')
-    print(f'starting id for new lanelets/ways: {max_id}')
-
-    # create list of [header, points, footer]
-    # 
-
-    # get list of way1 and way2 points
-    # walk along way1 to reach each split length, then record the index
-    # split each way into an array of [last point of prior, other...points, last point]
-    #
-    # for each split:
-        # if 0, return
-        # create a new lanelet
-        # lanelet 1:
-            # create a new way
-            # Fill it with split[0] - 1 to split[1] points
-            #
-    # for each way:
-    # create # splits new lanelets, with numbers starting after the largest number in the file
-    # grab the first point after each path length is reached
-    #from the first lanelet, remove the excess points
-    # for each split:
-        # create the header, then add the remaining points, and the end point
-        # create a new relation
-    # put the
-
-    # distance = 0
-    # distances = []
-    #
-    # metadata, data, end, index = get_way_data_from_file(way, osm_file)
-    #
-    # last_point = int(get_substring(data[0], num_to_skip=0))
-    # last_lat, last_lon = get_lat_lon_from_point(last_point, osm_file)
-    # for i, point_text in enumerate(data):
-    #     point = int(get_substring(point_text, num_to_skip=0))
-    #     lat, lon = get_lat_lon_from_point(point, osm_file)
-    #
-    #     delta_m_lat = lat_to_m * (lat - last_lat)
-    #     delta_m_lon = lon_to_m * (lon - last_lon)
-    #     dist_step = np.sqrt(delta_m_lat**2 + delta_m_lon**2)
-    #
-    #     distance += dist_step
-    #     distances.append(dist_step)
-    #     last_lat, last_lon = lat, lon
-    #
-    # return distance, distances
-
-
-def compute_lanelet_length(osm_file, lat, lon, lanelets=None):
-    # lat_to_m, earth is 40000000m in diameter, and 360 degrees (10000000m and 90 degrees to simplify)
-    # lat_to_m = 90/10000000 = 0.000009
-    # delta_m_lat = delta_lat * lat_to_m
-    # lon_to_m is dependent on latitude. lon_circumference = 40000000 * cos(lat)
-    # lon_to_m = 90/(10000000 * cos(lat))
-    # delta_m_lon = delta_lon * lon_to_m
-    # delta_m = sqrt(delta_m_lat**2 + delta_m_lon**2)
-    lat_to_m = 10000000.0/90.0
-    lon_to_m = (10000000.0 * np.cos(lat * np.pi/180))/90.0
-
-    # get list of lanelets
-    # for each lanelet
-        # get both boundaries
-        # use lat/lon gps to m to compute the length between each point in each boundary
-        # average the length of the two boundaries, and return that length
-
-    # get list of lanelets
-    lanelets = get_all_lanelets_from_file(osm_file)
-    close_points = {}
-
-    # for each lanelet
-    for lanelet in lanelets:
-        # get both boundaries
-        way1, way2 = get_ways_from_lanelet(lanelet, osm_file)
-        # use lat/lon gps to m to compute the length between each point in each boundary
-        d1, steps1, close1 = compute_way_length_from_file(osm_file, way1, lat_to_m, lon_to_m)
-        d2, steps2, close2 = compute_way_length_from_file(osm_file, way2, lat_to_m, lon_to_m)
-        if len(close1) > 0 or len(close2) > 0:
-            print('small')
-            for i in range(len(close1)):
-                # print(f'point {close1[i]}, from way {way1}, lanelet {lanelet}, distance < 0.25')
-                close_points[close1[i]] = way1
-            for i in range(len(close2)):
-                # print(f'point {close2[i]}, from way {way2}, lanelet {lanelet}, distance < 0.25')
-                close_points[close2[i]] = way1
-        distance = (d1 + d2) / 2
-        splits = int(distance // 150)
-        if splits > 0 and distance % 150 < 50:
-            splits -= 1
-        print(f'lanelet {lanelet} is {int(distance)} m, recommend {splits} splits')
-        if splits > 0:
-            split_lanelet_by_dist_from_file(osm_file, lanelet, way1, way2, 150, lat_to_m, lon_to_m)
-        # average the length of the two boundaries, and return that length
-    print()
-    for point in close_points.keys():
-        print(f'{point}')
-    return close_points
-
-
-def set_fixed_offset(osm_file, offset_x=0.0, offset_y=0.0, offset_lat=None, offset_lon=None, lat=28.1185796):
+
+# offset_x, offset_y in m to degrees, with the projection when given, otherwise the spherical scale at lat
+# lat is required to convert offset_x without a projection
+def fixed_offset_to_degrees(offset_x=0.0, offset_y=0.0, offset_lat=None, offset_lon=None, lat=None,
+                            projection=None):
+    if projection is not None:
+        projected_lat, projected_lon = projection.offset_to_degrees(offset_x, offset_y)
+        return (projected_lat if offset_lat is None else offset_lat,
+                projected_lon if offset_lon is None else offset_lon)
     if offset_lat is None:
         offset_lat = offset_y * (90.0 / 10000000.0)
     if offset_lon is None:
+        if lat is None:
+            raise ValueError('lat is required to convert offset_x to degrees without a projection')
         offset_lon = offset_x * (90.0 / (10000000.0 * np.cos(np.pi/180 * lat)))
-    print(f'{offset_lat}, {offset_lon}')
+    return offset_lat, offset_lon
+
+
+# Function: read_projection
+#
+# The TransverseMercator an OsmDocument of the file would use, without loading it. The <geoReference> is in the
+# header, so usually only the first lines are read. A map without one takes a streaming pass for its mean node
+#
+def read_projection(osm_file):
+    lat_sum, lon_sum, count = 0.0, 0.0, 0
+    for line in read_lines(osm_file):
+        stripped = line.strip()
+        if stripped.startswith('<geoReference>') and count == 0:
+            projection = TransverseMercator.from_georeference(stripped)
+            if projection is not None:
+                return projection
+        elif stripped.startswith(NODE_START):
+            lat_sum += float(get_attribute(stripped, 'lat'))
+            lon_sum += float(get_attribute(stripped, 'lon'))
+            count += 1
+    return TransverseMercator(lat_sum / max(count, 1), lon_sum / max(count, 1))
 
-    target = f'<geoReference>'
-    node_target = f'<node id=\"'
-    # <geoReference>+proj=tmerc +lat_0=28.11857965984839 +lon_0=-81.83067386240469 +k=1 +x_0=0 +y_0=0 +datum=WGS84 +units=m +geoidgrids=egm96_15.gtx +vunits=m +no_defs </geoReference>
-    # <node id='1' action='modify' visible='true' version='1' lat='28.12460546908' lon='-81.82879471276' />
 
-    with open(osm_file) as f:
-        contents = f.readlines()
+# <geoReference>+proj=tmerc +lat_0=28.11857965984839 +lon_0=-81.83067386240469 +k=1 +x_0=0 +y_0=0 +datum=WGS84 +units=m +geoidgrids=egm96_15.gtx +vunits=m +no_defs </geoReference>
+def offset_georeference_line(line, offset_lat, offset_lon):
+    if (line.strip())[0:len('<geoReference>')] != '<geoReference>':
+        return line
+    line = GEO_LAT_0.sub(lambda match: match.group(1) + str(float(match.group(2)) + offset_lat), line, count=1)
+    return GEO_LON_0.sub(lambda match: match.group(1) + str(float(match.group(2)) + offset_lon), line, count=1)
 
-    for i, line in enumerate(contents):
-        if (line.strip())[0:len(target)] == target:
-            lat = float(get_substring(line.strip(), '=', ' ', num_to_skip=1))
-            lat += offset_lat
-            line = replace_substring(line, str(lat), '=', ' ', num_to_skip=1)
-            lon = float(get_substring(line.strip(), '=', ' ', num_to_skip=2))
-            lon += offset_lon
-            line = replace_substring(line, str(lon), '=', ' ', num_to_skip=2)
-            contents[i] = line
-        elif (line.strip())[0:len(node_target)] == node_target:
-            lat = float(get_substring(line.strip(), num_to_skip=8))
-            lat += offset_lat
-            line = replace_substring(line, str(lat), num_to_skip=8)
-            lon = float(get_substring(line.strip(), num_to_skip=10))
-            lon += offset_lon
-            line = replace_substring(line, str(lon), num_to_skip=10)
-            contents[i] = line
-
-    os.remove(osm_file)
-    with open(osm_file, "a+") as f:
-        f.writelines(contents)
+
+# <node id='1' action='modify' visible='true' version='1' lat='28.12460546908' lon='-81.82879471276' />
+def offset_node_line(line, offset_lat, offset_lon):
+    lat, lon = get_attribute(line, 'lat'), get_attribute(line, 'lon')
+    if lat is not None:
+        line = set_attribute(line, 'lat', str(float(lat) + offset_lat))
+    if lon is not None:
+        line = set_attribute(line, 'lon', str(float(lon) + offset_lon))
+    return line
+
+
+# Generator pipeline pieces for rewriting a file without holding it in memory
+def read_lines(osm_file, buffer_size=STREAM_BUFFER_SIZE):
+    record_file_read(osm_file, full_scan=True)
+    with open(osm_file, buffering=buffer_size) as f:
+        yield from f
+
+
+def offset_lines(lines, offset_lat, offset_lon):
+    for line in lines:
+        if '<node ' in line:
+            yield offset_node_line(line, offset_lat, offset_lon)
+        elif '<geoReference>' in line:
+            yield offset_georeference_line(line, offset_lat, offset_lon)
+        else:
+            yield line
+
+
+# Function: write_npz_atomic
+#
+# np.savez to a temp file next to path, then swapped into place like write_lines_atomic
+#
+def write_npz_atomic(path, **arrays):
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        record_file_write(tmp_file)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+# Function: write_lines_atomic
+#
+# Writes lines to a temp file next to osm_file and then swaps it into place, so osm_file is never left half
+# written. lines can be a generator reading from osm_file itself, the original isn't touched until the end
+#
+def write_lines_atomic(osm_file, lines, buffer_size=STREAM_BUFFER_SIZE):
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(osm_file) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(osm_file)))
+    try:
+        with os.fdopen(fd, "w", buffering=buffer_size) as f:
+            f.writelines(lines)
+        record_file_write(tmp_file, rewrite=True)
+        if os.path.exists(osm_file):
+            shutil.copymode(osm_file, tmp_file)
+        os.replace(tmp_file, osm_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+# Class: InstrumentationStats
+#
+# Counters collected while instrumentation is enabled, see enable_instrumentation
+#
+# Members:
+#
+#    file_opens - Files opened for reading, maps and sidecar files alike
+#    full_scans - Times a whole file was read through: parses, hashes, index builds, streaming rewrites
+#    bytes_read, bytes_written - Bytes read from and written to files
+#    rewrites - Times an osm file was written out
+#    calls, seconds - Call count and total wall time of each function, by qualified name. Nested calls count
+#                     towards both the caller and the callee
+#
+class InstrumentationStats:
+
+    def __init__(self):
+        self.file_opens = 0
+        self.full_scans = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.rewrites = 0
+        self.calls = collections.Counter()
+        self.seconds = collections.defaultdict(float)
+
+    def as_dict(self):
+        return {'file_opens': self.file_opens, 'full_scans': self.full_scans, 'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written, 'rewrites': self.rewrites,
+                'functions': {name: {'calls': self.calls[name], 'seconds': self.seconds[name]}
+                              for name in self.calls}}
+
+    def report(self, top=20):
+        lines = [f'file opens {self.file_opens}, full scans {self.full_scans}, read {self.bytes_read} bytes, '
+                 f'wrote {self.bytes_written} bytes in {self.rewrites} rewrites']
+        for name in sorted(self.seconds, key=self.seconds.get, reverse=True)[:top]:
+            lines.append(f'{self.seconds[name]:10.4f} s {self.calls[name]:9d} calls  {name}')
+        return '\n'.join(lines)
+
+
+# None unless instrumentation is enabled, so the hooks below cost one comparison when it's off
+STATS = None
+_INSTRUMENTED = {}
+
+
+def record_file_read(path, nbytes=None, full_scan=False):
+    if STATS is None:
+        return
+    STATS.file_opens += 1
+    STATS.full_scans += full_scan
+    STATS.bytes_read += os.path.getsize(path) if nbytes is None else nbytes
+
+
+def record_file_write(path, rewrite=False):
+    if STATS is None:
+        return
+    STATS.bytes_written += os.path.getsize(path)
+    STATS.rewrites += rewrite
+
+
+def _timed(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            STATS.calls[name] += 1
+            STATS.seconds[name] += time.perf_counter() - start
+    return wrapper
+
+
+# Function: enable_instrumentation
+#
+# Starts counting file passes and bytes, and wraps every function and class method of this module in a timer.
+# Nothing is wrapped while it's off, so disabled instrumentation costs nothing beyond the file hooks. Generators
+# aren't wrapped, their time shows up in whatever consumes them
+#
+# Parameters:
+#
+#    report_at_exit - print InstrumentationStats.report() when the interpreter exits
+#
+# Returns:
+#
+#    The InstrumentationStats being filled in
+#
+def enable_instrumentation(report_at_exit=False):
+    global STATS
+    if STATS is None:
+        STATS = InstrumentationStats()
+        module = globals()
+        skip = {'record_file_read', 'record_file_write', 'enable_instrumentation', 'disable_instrumentation',
+                'get_instrumentation_stats'}
+        for name, value in list(module.items()):
+            if inspect.isfunction(value) and value.__module__ == __name__ and name not in skip \
+                    and not name.startswith('_') and not inspect.isgeneratorfunction(value):
+                _INSTRUMENTED[(None, name)] = value
+                module[name] = _timed(name, value)
+            elif inspect.isclass(value) and value.__module__ == __name__ and value is not InstrumentationStats:
+                for attribute, member in list(vars(value).items()):
+                    function = member.__func__ if isinstance(member, (classmethod, staticmethod)) else member
+                    if inspect.isfunction(function) and not inspect.isgeneratorfunction(function) \
+                            and not (attribute.startswith('__') and attribute != '__init__'):
+                        _INSTRUMENTED[(value, attribute)] = member
+                        timed = _timed(f'{name}.{attribute}', function)
+                        setattr(value, attribute, type(member)(timed) if function is not member else timed)
+    if report_at_exit:
+        atexit.register(lambda: STATS is not None and print(STATS.report()))
+    return STATS
+
+
+# Stops instrumentation and puts the original functions back, returning the stats collected
+def disable_instrumentation():
+    global STATS
+    stats = STATS
+    module = globals()
+    for (owner, name), original in _INSTRUMENTED.items():
+        if owner is None:
+            module[name] = original
+        else:
+            setattr(owner, name, original)
+    _INSTRUMENTED.clear()
+    STATS = None
+    return stats
+
+
+def get_instrumentation_stats():
+    return STATS
+
+
+# OSM_MANIP_STATS=1 turns instrumentation on for a whole run and prints the report at exit
+if os.environ.get('OSM_MANIP_STATS'):
+    enable_instrumentation(report_at_exit=True)
 
 
 # Press the green button in the gutter to run the script.
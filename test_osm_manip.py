@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+import osm_benchmark
+import osm_manip
+
+
+@pytest.fixture
+def osm_file(tmp_path):
+    path = str(tmp_path / 'map.osm')
+    osm_benchmark.generate_map(path, 40, duplicates=0, doubled=0, orphans=0)
+    return path
+
+
+def read(osm_file):
+    with open(osm_file) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('damage', ['empty', 'truncated'])
+def test_load_reparses_a_broken_cache(osm_file, damage):
+    expected = osm_manip.OsmDocument(osm_file)
+    cache_file = osm_file + '.cache.npz'
+    osm_manip.OsmDocument(osm_file, cache=True)
+    with open(cache_file, 'rb') as f:
+        data = f.read()
+    with open(cache_file, 'wb') as f:
+        f.write(b'' if damage == 'empty' else data[:len(data) // 2])
+
+    doc = osm_manip.OsmDocument(osm_file, cache=True)
+    assert doc.nodes.keys() == expected.nodes.keys()
+    assert doc.ways.keys() == expected.ways.keys()
+    assert doc.relations.keys() == expected.relations.keys()
+    assert doc.header == expected.header and doc.footer == expected.footer
+
+    # The cache was rewritten, and reads back the same file
+    assert os.path.getsize(cache_file) > len(data) // 2
+    output_file = osm_file + '.out'
+    osm_manip.OsmDocument(osm_file, cache=True).save(output_file)
+    assert read(output_file) == read(osm_file)
+
+
+def test_full_collection_keeps_top_level_relations(tmp_path):
+    osm_file = str(tmp_path / 'map.osm')
+    synthetic = osm_benchmark.generate_map(osm_file, 40, duplicates=0, doubled=2, orphans=3)
+    doc = osm_manip.OsmDocument(osm_file)
+    relations = set(doc.relations)
+
+    removed = doc.collect_garbage(('node', 'way', 'relation'), full=True)
+    assert removed == {'node': len(synthetic.orphan_nodes), 'way': 0, 'relation': 0}
+    assert set(doc.relations) == relations
+    assert all(lanelet in doc.relations for lanelet in synthetic.all_lanelets())
+
+
+@pytest.mark.parametrize('damage', ['empty', 'truncated'])
+def test_lookups_rebuild_a_broken_index(osm_file, damage):
+    doc = osm_manip.OsmDocument(osm_file)
+    way_id = next(iter(doc.ways))
+    node_id = doc.ways[way_id].refs[0]
+    index_file = osm_file + '.index.npz'
+    osm_manip.load_element_index(osm_file)
+    with open(index_file, 'rb') as f:
+        data = f.read()
+    with open(index_file, 'wb') as f:
+        f.write(b'' if damage == 'empty' else data[:len(data) // 2])
+
+    assert osm_manip.get_lat_lon_from_point(node_id, osm_file) == (doc.nodes[node_id].lat, doc.nodes[node_id].lon)
+    assert osm_manip.grab_start_and_end_points_from_way(way_id, osm_file) == (doc.ways[way_id].refs[0],
+                                                                               doc.ways[way_id].refs[-1])
+    assert osm_manip.get_way_data_from_file(way_id, osm_file)[0] is not None
+
+
+@pytest.mark.parametrize('damage', ['empty', 'truncated'])
+def test_routing_rebuilds_a_broken_graph_cache(tmp_path, damage):
+    osm_file = str(tmp_path / 'map.osm')
+    synthetic = osm_benchmark.generate_map(osm_file, 40, duplicates=0, doubled=0, orphans=0)
+    start, goal = synthetic.lanelets[0][0], synthetic.lanelets[-1][-1]
+    expected = osm_manip.route_lanelets(start, goal, osm_file, lane_change_cost=5.0)
+    cache_file = osm_file + '.route.npz'
+    with open(cache_file, 'rb') as f:
+        data = f.read()
+    with open(cache_file, 'wb') as f:
+        f.write(b'' if damage == 'empty' else data[:len(data) // 2])
+
+    assert osm_manip.route_lanelets(start, goal, osm_file, lane_change_cost=5.0) == expected
+    assert os.path.getsize(cache_file) == len(data)
+
+
+def test_doubled_centerlines_skip_lanelets_missing_a_boundary(tmp_path):
+    osm_file = str(tmp_path / 'map.osm')
+    synthetic = osm_benchmark.generate_map(osm_file, 40, duplicates=0, doubled=2, orphans=0)
+    broken, kept = synthetic.doubled_lanelets
+    text = read(osm_file)
+    start = text.index(f'<relation id="{broken}"')
+    right = text.index('role="right"', start)
+    line_start = text.rindex('\n', 0, right) + 1
+    with open(osm_file, 'w') as f:
+        f.write(text[:line_start] + text[text.index('\n', right) + 1:])
+
+    records = osm_manip.get_doubled_centerlines(osm_file)
+    assert [kept in record.lanelets for record in records] == [True]
+    assert all(broken not in record.lanelets for record in records)